@@ -0,0 +1,439 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Jürgen Legler
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+"""
+
+import sys
+import os
+import getopt
+import struct
+import time
+import json
+import platform
+import tempfile
+
+import numpy
+
+import pybsp
+
+# the lumps timed on their own, in the order pybsp reads them
+timed_lumps = ('vertices', 'edges', 'ledges', 'faces', 'planes', 'leaves',
+    'models', 'nodes', 'clipnodes', 'lface', 'texinfo', 'entities')
+
+# corners of a box are numbered x + 2 * y + 4 * z, the faces as corner
+# loops with their plane axis, the side of the box they are on and
+# whether they face against the plane normal. The loops run clockwise
+# seen from outside the box like the compilers write them.
+box_faces = (
+    ((0, 1, 3, 2), 2, 0, 1),
+    ((4, 6, 7, 5), 2, 1, 0),
+    ((0, 2, 6, 4), 0, 0, 1),
+    ((1, 5, 7, 3), 0, 1, 0),
+    ((0, 4, 5, 1), 1, 0, 1),
+    ((2, 3, 7, 6), 1, 1, 0),
+)
+box_edges = ((0, 1), (2, 3), (4, 5), (6, 7), (0, 2), (1, 3), (4, 6), (5, 7),
+    (0, 4), (1, 5), (2, 6), (3, 7))
+
+def usage():
+	print "bench.py [options] [map.bsp ...]"
+	print "times the stages of pybsp on the given maps, or on a generated one"
+	print "-b N boxes in the generated map (default 1000)"
+	print "-n N nodes in the generated map (default one leaf per box)"
+	print "-g file.bsp to only write the generated map"
+	print "-r N repetitions of each stage, the best is reported (default 3)"
+	print "-T N tile size of the tiled render pass (default 256)"
+	print "-R to skip the render passes"
+	print "-o file to write the json results to instead of stdout"
+	sys.exit(2)
+
+# edges index vertices with 16 bits
+max_boxes = 65536 / 8
+
+def ledge_template():
+    # signed edge numbers walking the corner loops of the faces, counted
+    # from 1 so the first edge of a box can be reversed as well
+    ledges = []
+    for loop, axis, side, flip in box_faces:
+        for i in range(4):
+            a = loop[i]
+            b = loop[(i + 1) % 4]
+            if (a, b) in box_edges:
+                ledges.append(box_edges.index((a, b)) + 1)
+            else:
+                ledges.append(-(box_edges.index((b, a)) + 1))
+    return ledges
+
+def split_grid(grid, nodes):
+    # breadth first kd split of the grid cells (i0, i1, j0, j1) into at
+    # most nodes + 1 regions, returns the splits as (region, axis, cell,
+    # front, back) and the final regions
+    regions = [(0, grid, 0, grid)]
+    splits = []
+    queue = [0]
+    while queue and len(splits) < nodes:
+        r = queue.pop(0)
+        i0, i1, j0, j1 = regions[r]
+        if i1 - i0 < 2 and j1 - j0 < 2:
+            continue
+        if i1 - i0 >= j1 - j0:
+            m = (i0 + i1) / 2
+            front, back = (m, i1, j0, j1), (i0, m, j0, j1)
+            axis = 0
+        else:
+            m = (j0 + j1) / 2
+            front, back = (i0, i1, m, j1), (i0, i1, j0, m)
+            axis = 1
+        regions[r] = front
+        regions.append(back)
+        splits.append((r, axis, m, r, len(regions) - 1))
+        queue.extend((r, len(regions) - 1))
+    return splits, regions
+
+def write_bsp(filename, boxes, nodes=None, cell=64.0, height=256.0):
+    # writes a bsp29 map of boxes centered in the cells of a square grid.
+    # Every box brings 8 vertices, 12 edges, 24 ledges and 6 faces, boxes
+    # share their planes and the node tree splits the grid into one empty
+    # leaf per region.
+    if boxes > max_boxes:
+        raise ValueError("bsp29 maps hold at most %i boxes" % max_boxes)
+    grid = int(numpy.ceil(numpy.sqrt(max(boxes, 1))))
+    if nodes is None:
+        nodes = boxes - 1
+    index = numpy.arange(boxes)
+    gx = (index / grid).astype(numpy.float32)
+    gy = (index % grid).astype(numpy.float32)
+    size = cell * 0.75
+    margin = (cell - size) / 2
+    top = height * (0.25 + 0.75 * ((index * 7) % 11) / 10.0)
+
+    lo = numpy.column_stack((gx * cell + margin, gy * cell + margin, numpy.zeros(boxes)))
+    hi = numpy.column_stack((gx * cell + margin + size, gy * cell + margin + size, top))
+    corner = numpy.arange(8)
+    bits = numpy.column_stack((corner & 1, (corner >> 1) & 1, (corner >> 2) & 1))
+    vertices = numpy.where(bits[None, :, :], hi[:, None, :], lo[:, None, :])
+    vertices = vertices.reshape(-1, 3).astype('<f4')
+
+    edges = numpy.array(box_edges, numpy.int64)[None, :, :] + 8 * index[:, None, None]
+    edges = numpy.concatenate(([[0, 0]], edges.reshape(-1, 2))).astype('<u2')
+
+    template = numpy.array(ledge_template())
+    first = 1 + 12 * index[:, None]
+    ledges = numpy.sign(template) * (abs(template) - 1 + first)
+    ledges = ledges.reshape(-1).astype('<i4')
+
+    # box faces on the same axis and distance share a plane, the split
+    # planes follow
+    face_axes = numpy.array([f[1] for f in box_faces])
+    sides = numpy.array([f[2] for f in box_faces])
+    axes = numpy.tile(face_axes, boxes)
+    dist = numpy.where(sides[None, :], hi[:, face_axes], lo[:, face_axes])
+    dist = dist.reshape(-1).astype('<f4')
+    keys, plane_ids = numpy.unique(axes * 1e6 + dist, return_inverse=True)
+    planes = numpy.zeros(len(keys), pybsp.BSP_File.dtypes['planes'])
+    planes['type'] = numpy.round(keys / 1e6)
+    planes['dist'] = keys - planes['type'] * 1e6
+    planes['normal'][numpy.arange(len(keys)), planes['type']] = 1
+
+    faces = numpy.zeros(boxes * 6, pybsp.BSP_File.dtypes['faces'])
+    faces['plane_id'] = plane_ids
+    faces['side'] = numpy.tile([f[3] for f in box_faces], boxes)
+    faces['ledge_id'] = numpy.arange(boxes * 6) * 4
+    faces['ledge_num'] = 4
+    faces['typelight'] = 0
+    faces['baselight'] = 255
+    faces['light'] = 255
+    faces['lightmap'] = 0xffffffff
+
+    splits, regions = split_grid(grid, nodes)
+    plane_base = len(planes)
+    split_planes = numpy.zeros(len(splits), pybsp.BSP_File.dtypes['planes'])
+    node_table = numpy.zeros(len(splits), pybsp.BSP_File.dtypes['nodes'])
+    # regions are split in place, remember which node or leaf holds each
+    owner = {0: None}
+    for n, (r, axis, m, front, back) in enumerate(splits):
+        split_planes['normal'][n, axis] = 1
+        split_planes['dist'][n] = m * cell
+        split_planes['type'][n] = axis
+        node_table['plane_id'][n] = plane_base + n
+        if owner[r] is not None:
+            parent, slot = owner[r]
+            node_table[slot][parent] = n
+        owner[front] = (n, 'front')
+        owner[back] = (n, 'back')
+    planes = numpy.concatenate((planes, split_planes))
+
+    # leaf 0 is the shared solid leaf, region k is leaf k + 1
+    leaves = numpy.zeros(len(regions) + 1, pybsp.BSP_File.dtypes['leaves'])
+    leaves['type'] = pybsp.CONTENTS_EMPTY
+    leaves['type'][0] = pybsp.CONTENTS_SOLID
+    leaves['vistlist'] = -1
+    lface = []
+    for k, (i0, i1, j0, j1) in enumerate(regions):
+        ids = [i * grid + j for i in range(i0, i1) for j in range(j0, j1) if i * grid + j < boxes]
+        leaves['face_id'][k + 1] = len(lface)
+        for b in ids:
+            lface.extend(range(b * 6, b * 6 + 6))
+        leaves['face_num'][k + 1] = len(lface) - leaves['face_id'][k + 1]
+        x0, x1 = i0 * cell, i1 * cell
+        y0, y1 = j0 * cell, j1 * cell
+        leaves['bounding_box'][k + 1] = ((x0, y0, 0), (x1, y1, height))
+        if owner[k] is not None:
+            parent, slot = owner[k]
+            node_table[slot][parent] = -(k + 2)
+    lface = numpy.array(lface, '<u2')
+    node_table['bounding_box'] = ((0, 0, 0), (grid * cell, grid * cell, height))
+    if len(node_table) == 0:
+        # a map needs a root node, let both sides lead to the only leaf
+        node_table = numpy.zeros(1, pybsp.BSP_File.dtypes['nodes'])
+        node_table['plane_id'] = 0
+        node_table['front'] = -2
+        node_table['back'] = -2
+
+    models = numpy.zeros(1, pybsp.BSP_File.dtypes['models'])
+    models['bounding_box'] = ((0, 0, 0), (grid * cell, grid * cell, height))
+    models['node_id1'] = -1
+    models['node_id2'] = -1
+    models['numleaves'] = len(regions)
+    models['face_num'] = len(faces)
+
+    texinfo = numpy.zeros(1, pybsp.BSP_File.dtypes['texinfo'])
+    texinfo['s'] = (1, 0, 0)
+    texinfo['t'] = (0, -1, 0)
+
+    lumps = {
+        'entities': '{\n"classname" "worldspawn"\n}\n{\n"classname" "info_player_start"\n"origin" "16 16 24"\n}\n\0',
+        'planes': planes.tostring(),
+        'miptex': struct.pack('<i', 0),
+        'vertices': vertices.tostring(),
+        'vislist': '',
+        'nodes': node_table.tostring(),
+        'texinfo': texinfo.tostring(),
+        'faces': faces.tostring(),
+        'lightmaps': '',
+        'clipnodes': '',
+        'leaves': leaves.tostring(),
+        'lface': lface.tostring(),
+        'edges': edges.tostring(),
+        'ledges': ledges.tostring(),
+        'models': models.tostring(),
+    }
+
+    out = open(filename, 'wb')
+    offset = 4 + 8 * len(pybsp.BSP_File.lump_order)
+    header = [29]
+    for name in pybsp.BSP_File.lump_order:
+        header.extend((offset, len(lumps[name])))
+        offset += (len(lumps[name]) + 3) & ~3
+    out.write(struct.pack('<%ii' % len(header), *header))
+    for name in pybsp.BSP_File.lump_order:
+        out.write(lumps[name])
+        out.write('\0' * (-len(lumps[name]) & 3))
+    out.close()
+
+# points and regions per spatial query stage
+query_count = 10000
+
+def temporary(suffix):
+    # a new empty file for this run, a name from mktemp could be taken
+    # before it is used
+    handle, name = tempfile.mkstemp(suffix)
+    os.close(handle)
+    return name
+
+def timed(repeat, setup, run):
+    # best and mean wall time of run(), setup() is called untimed before
+    # every run
+    times = []
+    result = None
+    for i in range(repeat):
+        setup()
+        start = time.time()
+        result = run()
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times), result
+
+def stage(results, name, best, mean, records=None, unit="records", nbytes=None):
+    entry = {'stage': name, 'seconds': best, 'mean_seconds': mean}
+    if records is not None:
+        entry[unit] = records
+        entry[unit + '_per_s'] = records / max(best, 1e-9)
+    if nbytes is not None:
+        entry['bytes'] = nbytes
+        entry['bytes_per_s'] = nbytes / max(best, 1e-9)
+    results.append(entry)
+
+def bench_map(filename, repeat, tile, render):
+    results = []
+    nothing = lambda: None
+
+    best, mean, f = timed(repeat, nothing, lambda: pybsp.BSP_File(filename, lazy=True))
+    if f.invalid:
+        raise IOError(f.error)
+    stage(results, 'open', best, mean)
+
+    def header():
+        f.file.seek(f.base)
+        f.read_header()
+    best, mean, r = timed(repeat, nothing, header)
+    stage(results, 'read_header', best, mean, len(pybsp.BSP_File.lump_order), "lumps")
+
+    for columnar in (False, True):
+        f.columnar = columnar
+        suffix = columnar and ':columnar' or ''
+        for name in timed_lumps:
+            num = f.header[name].get('num')
+            best, mean, r = timed(repeat, lambda: f.release(name), lambda: getattr(f, name))
+            stage(results, 'read_' + name + suffix, best, mean, num, nbytes=f.header[name]['size'])
+
+    num = f.header['vertices']['num']
+    best, mean, r = timed(repeat, lambda: f.release('minimum', 'maximum'), f.get_max)
+    stage(results, 'get_max', best, mean, num, "vertices")
+
+    num = f.header['faces']['num']
+    best, mean, r = timed(repeat, lambda: f.release('polygon_offsets', 'polygon_vertices'), f.get_polygons)
+    stage(results, 'get_polygons', best, mean, num, "faces")
+
+    best, mean, r = timed(repeat, lambda: f.release('face_mins', 'face_maxs', 'bvh_faces', 'bvh_mins', 'bvh_maxs'), f.get_bvh)
+    stage(results, 'get_bvh', best, mean, num, "faces")
+
+    # queries spread over the extent of the map
+    random = numpy.random.RandomState(0)
+    low = numpy.array(f.minimum)
+    high = numpy.array(f.maximum)
+    corners = random.uniform(low[:2], high[:2], (query_count, 2))
+    best, mean, r = timed(repeat, nothing, lambda: f.faces_in_region(corners, corners + 256))
+    stage(results, 'faces_in_region', best, mean, query_count, "queries")
+    points = random.uniform(low, high, (query_count, 3))
+    best, mean, r = timed(repeat, nothing, lambda: f.nearest_surface(points))
+    stage(results, 'nearest_surface', best, mean, query_count, "queries")
+
+    best, mean, view = timed(repeat, nothing, lambda: pybsp.overview(f))
+    offsets, points, m_min, m_max = view
+    stage(results, 'overview', best, mean, len(offsets) - 1, "faces")
+
+    output = temporary('.bsp')
+    def rewrite():
+        writer = pybsp.BSP_Writer(f)
+        writer.compact()
+        return writer.write(output)
+    best, mean, r = timed(repeat, nothing, rewrite)
+    stage(results, 'rewrite', best, mean, f.header['faces']['num'], "faces", r)
+    os.remove(output)
+
+    for extension in ('.obj', '.glb'):
+        output = temporary(extension)
+        best, mean, r = timed(repeat, lambda: f.release('polygon_st', 'polygon_uvs'), lambda: pybsp.export_mesh(f, output, 0, True))
+        stage(results, 'export_' + extension[1:], best, mean, r, "triangles", os.path.getsize(output))
+        os.remove(output)
+
+    if render:
+        faces = len(offsets) - 1
+        extent = m_max - m_min
+        pixels = int(extent[0]) * int(extent[1])
+        best, mean, image = timed(repeat, nothing, lambda: pybsp.render_soft(f, *view))
+        stage(results, 'render_soft', best, mean, faces, "faces")
+        results[-1]['pixels_per_s'] = pixels / max(best, 1e-9)
+
+        output = temporary('.png')
+        best, mean, r = timed(repeat, nothing, lambda: image.save(output, "PNG"))
+        stage(results, 'encode_png', best, mean, pixels, "pixels", os.path.getsize(output))
+
+        best, mean, r = timed(repeat, nothing, lambda: pybsp.render_tiled(f, offsets, points, m_min, m_max, output, 1.0, tile))
+        stage(results, 'render_tiled', best, mean, faces, "faces")
+        results[-1]['pixels_per_s'] = pixels / max(best, 1e-9)
+        os.remove(output)
+
+    counts = {}
+    for name in pybsp.BSP_File.lump_order:
+        counts[name] = f.header[name].get('num', f.header[name]['size'])
+    return {'map': filename, 'filesize': f.filesize, 'counts': counts, 'stages': results}
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:n:g:r:T:Ro:')
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+
+    boxes = 1000
+    nodes = None
+    generate = None
+    repeat = 3
+    tile = 256
+    render = True
+    output = None
+    for o, a in opts:
+        if o == "-h":
+            usage()
+        elif o == "-b":
+            boxes = max(int(a), 1)
+        elif o == "-n":
+            nodes = max(int(a), 0)
+        elif o == "-g":
+            generate = a
+        elif o == "-r":
+            repeat = max(int(a), 1)
+        elif o == "-T":
+            tile = max(int(a), 1)
+        elif o == "-R":
+            render = False
+        elif o == "-o":
+            output = a
+
+    if generate is not None:
+        write_bsp(generate, boxes, nodes)
+        return
+
+    maps = pybsp.find_maps(args)
+    generated = None
+    if len(maps) == 0:
+        generated = temporary('.bsp')
+        start = time.time()
+        write_bsp(generated, boxes, nodes)
+        print >> sys.stderr, "generated %i boxes in %.3fs" % (boxes, time.time() - start)
+        maps = [generated]
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'maps': [],
+    }
+    try:
+        for filename in maps:
+            report['maps'].append(bench_map(filename, repeat, tile, render))
+            if filename == generated:
+                report['maps'][-1]['generated'] = {'boxes': boxes, 'nodes': nodes}
+    finally:
+        if generated is not None:
+            os.remove(generated)
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if output is None:
+        print text
+    else:
+        out = open(output, 'w')
+        out.write(text + '\n')
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
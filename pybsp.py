@@ -26,6 +26,23 @@ import os
 from stat import *
 import getopt
 import struct
+import mmap
+import glob
+import time
+import itertools
+import multiprocessing
+import collections
+import zlib
+import hashlib
+import json
+import resource
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import StringIO
+
+import numpy
 
 import cairo
 import Image
@@ -38,48 +55,259 @@ from OpenGL.GLUT import *
 
 from cgkit.cgtypes import vec3
 
+# a quoted key or value, or a brace opening or closing an entity
+entity_token = re.compile(r'"([^"]*)"|([{}])')
+
+# first bytes of a parsed map cache file, bumped when the layout changes
+CACHE_MAGIC = "PYBSPC01"
+
+CONTENTS_EMPTY = -1
+CONTENTS_SOLID = -2
+
+TEX_SPECIAL = 1
+
+# hull traces stop this far in front of the plane they hit
+DIST_EPSILON = 0.03125
+
 only_list = 0
+use_mmap = False
+software = False
+tile_size = 0
+pyramid = False
+resolution = 1.0
+cache_dir = None
+profile_file = None
+mesh_format = None
+group_textures = False
+rewrite_dir = None
+strip_lumps = []
+compact_maps = False
 
 def usage():
-	print "pywad.py pakfile \"extraction regexp\""
+	print "pybsp.py [options] map.bsp|directory|pattern|pakfile [\"extraction regexp\"] ..."
+	print "   maps inside a pak are read in place, pak0.pak:maps/e1m1.bsp names one"
 	print "-l for listing"
+	print "-m to memory-map the bsp file"
+	print "-z is accepted for old scripts, lumps are always read when used"
+	print "-s to render in software, no display needed"
+	print "-j N to render maps in N processes, arguments may be"
+	print "   several files, directories or glob patterns"
+	print "-t to extract the textures of the maps to textures/"
+	print "-p palette.lmp to use for the textures"
+	print "-T N to render in software in N x N pixel tiles, streaming the png"
+	print "-r S pixels per map unit for tiled rendering"
+	print "-Z to write a zoomable tile pyramid name/z/x/y.png instead, with"
+	print "   the tile size of -T (default 256), unchanged tiles are kept"
+	print "-e obj|glb to export the faces of the world as a triangle mesh instead"
+	print "-g to group the exported triangles by texture"
+	print "-W dir to write copies of the maps to dir instead, under the path they"
+	print "   were given with or their path in the archive, with"
+	print "   -x lump,... to leave lumps out (vislist,lightmaps for servers)"
+	print "   -k to drop unused vertices, edges and planes"
+	print "-c dir to keep parsed maps in dir and reuse them while unchanged"
+	print "-S port to serve overviews of the maps below the directory argument"
+	print "   (default .) on http://127.0.0.1:port/render?map=name&model=0&scale=1"
+	print "   &region=x0,y0,x1,y1, -j requests render at once"
+	print "-w S to keep watching the maps, checking every S seconds, and render"
+	print "   the ones whose geometry changed"
+	print "--profile file to write the time, bytes and records of every stage"
+	print "   and how far each map raised the peak memory of its process as json"
+	print "   to file, - for stdout"
 	sys.exit(2)
 
 
-try:
-	opts, args = getopt.getopt(sys.argv[1:], 'hl')
-except getopt.GetoptError, err:
-	print str(err)
-	usage()
-
+class LRU_Cache:
+    # bounded mapping that forgets the least recently used entries
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# stages of the map being rendered, None while nothing is profiled
+profile = None
+
+# called with the map and each stage dict as it is recorded, to forward
+# them to a metrics system. Pool workers inherit the hooks when forked.
+profile_hooks = []
+
+class Profile:
+    def __init__(self, name):
+        self.map = name
+        self.start = time.time()
+        self.stages = []
+        self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def add(self, stage, seconds, **info):
+        entry = {'stage': stage, 'seconds': seconds}
+        for key in info:
+            if info[key] is not None:
+                entry[key] = info[key]
+        self.stages.append(entry)
+        for hook in profile_hooks:
+            hook(self.map, entry)
+
+    def finish(self):
+        # ru_maxrss is in kilobytes on linux and the peak of the whole
+        # process, workers and watch mode handle many maps. The growth is
+        # how far this map raised it, 0 when it stayed below the peak of
+        # an earlier map.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.add('total', time.time() - self.start,
+                process_peak_rss_kb=peak_rss, peak_rss_growth_kb=peak_rss - self.peak_rss)
+        return {'map': self.map, 'stages': self.stages}
+
+def profile_stage(name, start, **info):
+    # records a stage that began at start
+    if profile is not None:
+        profile.add(name, time.time() - start, **info)
 
-for o, a in opts:
-	if o == "-h":
-		usage()
-	elif o == "-l":
-		list_only = 1
-		print "listing files only"
-	else :
-		print "unknown option %s" % o
-
-if len(args) < 1:
-	usage()
-
-ifile = args[0]
 
 class BSP_File:
-    def __init__(self, filename):
+    # attributes that are read on first access, and the method reading them
+    loaders = {
+        'vertices': 'read_vertices',
+        'edges': 'read_edges',
+        'ledges': 'read_ledges',
+        'faces': 'read_faces',
+        'planes': 'read_planes',
+        'leaves': 'read_leaves',
+        'models': 'read_models',
+        'nodes': 'read_nodes',
+        'clipnodes': 'read_clipnodes',
+        'lface': 'read_lface',
+        'texinfo': 'read_texinfo',
+        'entities': 'read_entities',
+        'entity_index': 'read_entities',
+        'lightmaps': 'read_lightmaps',
+        'polygon_st': 'get_polygon_st',
+        'polygon_uvs': 'get_uvs',
+        'polygon_lightmap_uvs': 'get_lightmap_uvs',
+        'lightmap_mins': 'get_lightmap_extents',
+        'lightmap_sizes': 'get_lightmap_extents',
+        'lightmap_atlas': 'get_lightmap_atlas',
+        'lightmap_rects': 'get_lightmap_atlas',
+        'face_mins': 'get_face_bounds',
+        'face_maxs': 'get_face_bounds',
+        'bvh_faces': 'get_bvh',
+        'bvh_mins': 'get_bvh',
+        'bvh_maxs': 'get_bvh',
+        'vislist': 'read_vislist',
+        'miptex': 'read_miptex',
+        'miptex_data': 'read_miptex',
+        'minimum': 'get_max',
+        'maximum': 'get_max',
+        'polygon_offsets': 'get_polygons',
+        'polygon_vertices': 'get_polygons',
+        'node_planes': 'get_node_table',
+        'node_children': 'get_node_table',
+        'clip_planes': 'get_clip_table',
+        'clip_children': 'get_clip_table',
+    }
+
+    # numpy record layouts matching the header struct definitions
+    dtypes = {
+        'vertices': numpy.dtype(('<f4', (3,))),
+        'edges': numpy.dtype(('<u2', (2,))),
+        'ledges': numpy.dtype('<i4'),
+        'faces': numpy.dtype([('plane_id', '<i2'), ('side', '<i2'),
+            ('ledge_id', '<i4'), ('ledge_num', '<i2'), ('texinfo_id', '<i2'),
+            ('typelight', 'u1'), ('baselight', 'u1'), ('light', 'u1', (2,)),
+            ('lightmap', '<u4')]),
+        'planes': numpy.dtype([('normal', '<f4', (3,)), ('dist', '<f4'),
+            ('type', '<u4')]),
+        'leaves': numpy.dtype([('type', '<i4'), ('vistlist', '<i4'),
+            ('bounding_box', '<i2', (2, 3)), ('face_id', '<u2'),
+            ('face_num', '<u2'), ('ambient', 'u1', (4,))]),
+        'models': numpy.dtype([('bounding_box', '<f4', (2, 3)),
+            ('origin', '<f4', (3,)), ('node_id0', '<i4'), ('node_id1', '<i4'),
+            ('node_id2', '<i4'), ('node_id3', '<i4'), ('numleaves', '<i4'),
+            ('face_id', '<i4'), ('face_num', '<i4')]),
+        'nodes': numpy.dtype([('plane_id', '<i4'), ('front', '<i2'),
+            ('back', '<i2'), ('bounding_box', '<i2', (2, 3)),
+            ('face_id', '<u2'), ('face_num', '<u2')]),
+        'clipnodes': numpy.dtype([('plane_id', '<i4'), ('front', '<i2'),
+            ('back', '<i2')]),
+        'lface': numpy.dtype('<u2'),
+        'texinfo': numpy.dtype([('s', '<f4', (3,)), ('s_offset', '<f4'),
+            ('t', '<f4', (3,)), ('t_offset', '<f4'), ('miptex', '<u4'),
+            ('flags', '<u4')]),
+    }
+
+    # entity keys with a value -> entities lookup table
+    entity_keys = ('classname', 'targetname', 'model')
+
+    # decoded visibility rows kept per map
+    vis_cache_size = 1024
+
+    # faces per leaf of the bounding volume hierarchy
+    bvh_leaf_size = 8
+
+    # lumps in the order of the header
+    lump_order = ('entities', 'planes', 'miptex', 'vertices', 'vislist',
+        'nodes', 'texinfo', 'faces', 'lightmaps', 'clipnodes', 'leaves',
+        'lface', 'edges', 'ledges', 'models')
+
+    # lumps the pictures are made from, other lumps (entities, lighting,
+    # vis) can change without changing the picture
+    geometry_lumps = ('vertices', 'edges', 'ledges', 'faces', 'models')
+
+    # derived tables stored in the cache next to the lump arrays
+    cached_tables = ('polygon_offsets', 'polygon_vertices')
+
+    def __init__(self, filename, use_mmap=False, lazy=False, columnar=False, cache_dir=None, base=0, size=None):
         self.filename = filename;
         self.invalid = False
         self.header = {} 
+        self.map = None
+        self.columnar = columnar
+        self.arrays = {}
+        self.vis_cache = LRU_Cache(BSP_File.vis_cache_size)
+        self.bytes_read = 0
         try:
-            self.file = open(filename, 'rb')
+            # unbuffered, the header is tiny and every lump is a single read
+            self.file = open(filename, 'rb', 0)
         except:
             self.invalid = True
             self.error = "could not open file \"%s\"" % filename
             return None
-        self.filesize = os.stat(self.filename)[ST_SIZE]
+        # a map inside an archive starts at base, lump offsets are
+        # relative to it
+        self.base = base
+        self.filesize = os.stat(self.filename)[ST_SIZE] - base
+        if size is not None:
+            self.filesize = size
+        self.mtime = os.stat(self.filename).st_mtime
+        if use_mmap:
+            # read only mappings of the same file share the page cache
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file.seek(base, os.SEEK_SET)
         self.read_header()
+        if cache_dir is not None:
+            if self.load_cache(cache_dir):
+                return None
+            try:
+                self.save_cache(cache_dir)
+            except (IOError, OSError):
+                # an unwritable or full cache only costs the next load
+                pass
+        if lazy:
+            return None
         self.read_vertices()
         self.read_edges()
         self.read_ledges()
@@ -90,8 +318,22 @@ class BSP_File:
         self.read_nodes()
         self.get_max()
 
+    def __getattr__(self, name):
+        if name in BSP_File.loaders and not self.invalid:
+            getattr(self, BSP_File.loaders[name])()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def release(self, *names):
+        # drop decoded lumps, they are read again on the next access
+        if len(names) == 0:
+            names = BSP_File.loaders.keys()
+        for name in names:
+            self.__dict__.pop(name, None)
+            self.arrays.pop(name, None)
 
     def read_long(self):
+        self.bytes_read += 4
         return array.array('I', self.file.read(4))[0]
 
     def read_header(self):
@@ -167,7 +409,7 @@ class BSP_File:
         self.header['planes']['struct_size'] = struct.calcsize(s)
         self.header['planes']['num'] = self.header['planes']['size'] / self.header['planes']['struct_size']
 
-        s = "llhhhhhhHHcccc"
+        s = "iihhhhhhHHcccc"
         self.header['leaves']['struct'] = s
         self.header['leaves']['struct_size'] = struct.calcsize(s)
         self.header['leaves']['num'] = self.header['leaves']['size'] / self.header['leaves']['struct_size']
@@ -177,11 +419,26 @@ class BSP_File:
         self.header['models']['struct_size'] = struct.calcsize(s)
         self.header['models']['num'] = self.header['models']['size'] / self.header['models']['struct_size']
 
-        s = "lHHHHHHHHHH"
+        s = "ihhhhhhhhHH"
         self.header['nodes']['struct'] = s
         self.header['nodes']['struct_size'] = struct.calcsize(s)
         self.header['nodes']['num'] = self.header['nodes']['size'] / self.header['nodes']['struct_size']
 
+        s = "ihh"
+        self.header['clipnodes']['struct'] = s
+        self.header['clipnodes']['struct_size'] = struct.calcsize(s)
+        self.header['clipnodes']['num'] = self.header['clipnodes']['size'] / self.header['clipnodes']['struct_size']
+
+        s = "H"
+        self.header['lface']['struct'] = s
+        self.header['lface']['struct_size'] = struct.calcsize(s)
+        self.header['lface']['num'] = self.header['lface']['size'] / self.header['lface']['struct_size']
+
+        s = "ffffffffII"
+        self.header['texinfo']['struct'] = s
+        self.header['texinfo']['struct_size'] = struct.calcsize(s)
+        self.header['texinfo']['num'] = self.header['texinfo']['size'] / self.header['texinfo']['struct_size']
+
     def print_header_info(self):
         print "Header Info:"
         for k in self.header:
@@ -200,15 +457,175 @@ class BSP_File:
         else:
             print " " +  key + ": " + "%i" % self.header[key]
 
+    def read_lump(self, name):
+        offset = self.base + self.header[name]['offset']
+        size = self.header[name]['size']
+        self.bytes_read += size
+        if self.map is not None:
+            # zero copy view into the mapping
+            return buffer(self.map, offset, size)
+        self.file.seek(offset, os.SEEK_SET)
+        return self.file.read(size)
+
+    def read_records(self, name):
+        limit = self.header[name]['num']
+        if limit == 0:
+            return []
+        struct_definition = self.header[name]['struct']
+        # one unpack for the whole lump, then split it into records
+        data = struct.Struct(struct_definition * limit).unpack_from(self.read_lump(name))
+        return zip(*[iter(data)] * (len(data) / limit))
+
+    def content_hash(self):
+        h = hashlib.sha1()
+        self.file.seek(self.base, os.SEEK_SET)
+        left = self.filesize
+        while left > 0:
+            data = self.file.read(min(left, 1 << 20))
+            if not data:
+                break
+            h.update(data)
+            left -= len(data)
+        return h.hexdigest()
+
+    def lump_hash(self, names):
+        h = hashlib.sha1()
+        for name in names:
+            h.update(name)
+            h.update(self.read_lump(name))
+        return h.hexdigest()
+
+    def cache_file(self, cache_dir):
+        key = os.path.abspath(self.filename)
+        if self.base:
+            key += ":%i" % self.base
+        return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + ".cache")
+
+    def save_cache(self, cache_dir):
+        # lump arrays, polygon index and bounds as raw arrays behind a json
+        # index, so a warm load only maps the file
+        for name in BSP_File.dtypes:
+            self.lump_array(name)
+        tables = {}
+        for name in BSP_File.cached_tables:
+            tables[name] = getattr(self, name)
+        tables['minimum'] = numpy.array(self.minimum, numpy.float64)
+        tables['maximum'] = numpy.array(self.maximum, numpy.float64)
+
+        index = {'size': self.filesize, 'mtime': self.mtime, 'hash': self.content_hash(),
+                'lumps': {}, 'tables': {}}
+        offset = 0
+        data = []
+        for kind, arrays in (('lumps', self.arrays), ('tables', tables)):
+            for name in sorted(arrays):
+                a = numpy.ascontiguousarray(arrays[name])
+                index[kind][name] = [a.dtype.str, a.shape, offset]
+                data.append(a.tostring())
+                offset += a.nbytes
+                # keep every array aligned
+                data.append('\0' * (-offset % 16))
+                offset += -offset % 16
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.write_cache(cache_dir, index, data)
+
+    def write_cache(self, cache_dir, index, data):
+        # written to a temporary name and renamed, concurrent readers only
+        # ever see complete files
+        text = json.dumps(index)
+        text += ' ' * (-(len(text) + 12) % 16)
+        cachefile = self.cache_file(cache_dir)
+        temp = "%s.%i" % (cachefile, os.getpid())
+        try:
+            out = open(temp, 'wb')
+            out.write(CACHE_MAGIC)
+            out.write(struct.pack("<I", len(text)))
+            out.write(text)
+            for d in data:
+                out.write(d)
+            out.close()
+            os.rename(temp, cachefile)
+        except (IOError, OSError):
+            # a full disk leaves no partial file behind
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def load_cache(self, cache_dir):
+        # valid if size and mtime match, or if the content hash still does
+        try:
+            cache = open(self.cache_file(cache_dir), 'rb')
+        except IOError:
+            return False
+        try:
+            cachemap = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return False
+        finally:
+            cache.close()
+        def table(kind, name, dtype):
+            s, shape, offset = index[kind][name]
+            # vertices and edges keep their last dimension in the dtype
+            count = int(numpy.prod(shape[:len(shape) - len(dtype.shape)]))
+            return numpy.frombuffer(buffer(cachemap, base + offset), dtype, count).reshape(shape)
+
+        # a damaged or truncated file is a miss, it is written again
+        try:
+            if cachemap[:8] != CACHE_MAGIC:
+                return False
+            length = struct.unpack_from("<I", cachemap, 8)[0]
+            index = json.loads(cachemap[12:12 + length])
+            if index['size'] != self.filesize:
+                return False
+            base = 12 + length
+            touched = index['mtime'] != self.mtime
+            if touched and index['hash'] != self.content_hash():
+                return False
+            arrays = {}
+            tables = {}
+            for name in index['lumps']:
+                arrays[str(name)] = table('lumps', name, BSP_File.dtypes[name])
+            for name in index['tables']:
+                tables[str(name)] = table('tables', name, numpy.dtype(str(index['tables'][name][0])))
+            minimum = tables.pop('minimum').tolist()
+            maximum = tables.pop('maximum').tolist()
+        except (ValueError, KeyError, TypeError, struct.error):
+            return False
+
+        if touched:
+            # only touched, store the new mtime so the next load does not
+            # hash the map again
+            index['mtime'] = self.mtime
+            try:
+                self.write_cache(cache_dir, index, [buffer(cachemap, base)])
+            except (IOError, OSError):
+                pass
+        self.arrays.update(arrays)
+        for name in tables:
+            setattr(self, name, tables[name])
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cache_map = cachemap
+        return True
+
+    def lump_array(self, name):
+        # the whole lump as one numpy array, a view of the mapping with -m.
+        # Profiled as lump_<name> when it is built, inside the loader
+        # asking for it.
+        if name not in self.arrays:
+            start = time.time()
+            bytes_read = self.bytes_read
+            self.arrays[name] = numpy.frombuffer(self.read_lump(name),
+                    BSP_File.dtypes[name], self.header[name]['num'])
+            profile_stage('lump_' + name, start, bytes=self.bytes_read - bytes_read,
+                    records=self.header[name]['num'])
+        return self.arrays[name]
+
     def read_vertices(self):
-        self.file.seek(self.header['vertices']['offset'], os.SEEK_SET)
-        limit = self.header['vertices']['num']
-        size = self.header['vertices']['struct_size']
-        struct_definition = self.header['vertices']['struct']
-        self.vertices = []
-        for i in range(limit):
-            v = struct.unpack(struct_definition, self.file.read(size))
-            self.vertices.append((v[0] , v[1] , v[2] ))
+        if self.columnar:
+            self.vertices = self.lump_array('vertices')
+            return
+        self.vertices = self.read_records('vertices')
 
     def print_vertices(self):
         limit = self.header['vertices']['num']
@@ -218,13 +635,10 @@ class BSP_File:
 
 
     def read_edges(self):
-        self.file.seek(self.header['edges']['offset'], os.SEEK_SET)
-        limit = self.header['edges']['num']
-        size = self.header['edges']['struct_size']
-        struct_definition = self.header['edges']['struct']
-        self.edges = []
-        for i in range(limit):
-            self.edges.append(struct.unpack(struct_definition, self.file.read(size)))
+        if self.columnar:
+            self.edges = self.lump_array('edges')
+            return
+        self.edges = self.read_records('edges')
 
 
     def print_edges(self):
@@ -234,14 +648,10 @@ class BSP_File:
             print "     0: " + str(self.edges[i][0]) + " - 1: " + str(self.edges[i][1]) 
 
     def read_ledges(self):
-        self.file.seek(self.header['ledges']['offset'], os.SEEK_SET)
-        limit = self.header['ledges']['num']
-        size = self.header['ledges']['struct_size']
-        struct_definition = self.header['ledges']['struct']
-        self.ledges = []
-        for i in range(limit):
-            data = self.file.read(size)
-            self.ledges.append(struct.unpack(struct_definition, data))
+        if self.columnar:
+            self.ledges = self.lump_array('ledges')
+            return
+        self.ledges = self.read_records('ledges')
 
     def print_ledges(self):
         limit = self.header['ledges']['num']
@@ -249,13 +659,11 @@ class BSP_File:
             print str(i) + ": " + str(self.ledges[i])
 
     def read_faces(self):
-        self.file.seek(self.header['faces']['offset'], os.SEEK_SET)
-        limit = self.header['faces']['num']
-        size = self.header['faces']['struct_size']
-        struct_definition = self.header['faces']['struct']
+        if self.columnar:
+            self.faces = self.lump_array('faces')
+            return
         self.faces = []
-        for i in range(limit):
-            data = struct.unpack(struct_definition, self.file.read(size))
+        for data in self.read_records('faces'):
             face = {}
             face['plane_id'] = data[0]
             face['side'] = data[1]
@@ -279,13 +687,11 @@ class BSP_File:
                 print " " + k + ": " + str(self.faces[i][k])
 
     def read_planes(self):
-        self.file.seek(self.header['planes']['offset'], os.SEEK_SET)
-        limit = self.header['planes']['num']
-        size = self.header['planes']['struct_size']
-        struct_definition = self.header['planes']['struct']
+        if self.columnar:
+            self.planes = self.lump_array('planes')
+            return
         self.planes = []
-        for i in range(limit):
-            data = struct.unpack(struct_definition, self.file.read(size))
+        for data in self.read_records('planes'):
             plane = {}
             plane['normal'] = (data[0], data[1], data[2])
             plane['dist'] = data[3]
@@ -293,13 +699,11 @@ class BSP_File:
             self.planes.append(plane)
 
     def read_models(self):
-        self.file.seek(self.header['models']['offset'], os.SEEK_SET)
-        limit = self.header['models']['num']
-        size = self.header['models']['struct_size']
-        struct_definition = self.header['models']['struct']
+        if self.columnar:
+            self.models = self.lump_array('models')
+            return
         self.models = []
-        for i in range(limit):
-            data = struct.unpack(struct_definition, self.file.read(size))
+        for data in self.read_records('models'):
             model = {}
             model['bounding_box'] = (vec3(data[0], data[1], data[2]), vec3(data[3], data[4], data[5]))
             model['origin'] = vec3(data[6], data[7], data[8])
@@ -313,13 +717,11 @@ class BSP_File:
             self.models.append(model)
 
     def read_leaves(self):
-        self.file.seek(self.header['leaves']['offset'], os.SEEK_SET)
-        limit = self.header['leaves']['num']
-        size = self.header['leaves']['struct_size']
-        struct_definition = self.header['leaves']['struct']
+        if self.columnar:
+            self.leaves = self.lump_array('leaves')
+            return
         self.leaves = []
-        for i in range(limit):
-            data = struct.unpack(struct_definition, self.file.read(size))
+        for data in self.read_records('leaves'):
             leaf = {}
             leaf['type'] = data[0]
             leaf['vistlist'] = data[1]
@@ -335,13 +737,11 @@ class BSP_File:
             self.leaves.append(leaf)
 
     def read_nodes(self):
-        self.file.seek(self.header['nodes']['offset'], os.SEEK_SET)
-        limit = self.header['nodes']['num']
-        size = self.header['nodes']['struct_size']
-        struct_definition = self.header['nodes']['struct']
+        if self.columnar:
+            self.nodes = self.lump_array('nodes')
+            return
         self.nodes = []
-        for i in range(limit):
-            data = struct.unpack(struct_definition, self.file.read(size))
+        for data in self.read_records('nodes'):
             node = {}
             node['plane_id'] = data[0]
             node['front'] = data[1]
@@ -351,19 +751,902 @@ class BSP_File:
             node['face_num'] = data[10]
             self.nodes.append(node)
 
+    def read_clipnodes(self):
+        if self.columnar:
+            self.clipnodes = self.lump_array('clipnodes')
+            return
+        self.clipnodes = []
+        for data in self.read_records('clipnodes'):
+            node = {}
+            node['plane_id'] = data[0]
+            node['front'] = data[1]
+            node['back'] = data[2]
+            self.clipnodes.append(node)
+
+    def read_lface(self):
+        if self.columnar:
+            self.lface = self.lump_array('lface')
+            return
+        self.lface = self.read_records('lface')
+
+    def read_entities(self):
+        # one pass over the quoted strings and braces of the lump
+        text = str(self.read_lump('entities')).split('\0', 1)[0]
+        self.entities = []
+        self.entity_index = {}
+        for key in BSP_File.entity_keys:
+            self.entity_index[key] = {}
+        entity = None
+        key = None
+        for token in entity_token.finditer(text):
+            quoted = token.group(1)
+            if quoted is None:
+                if token.group(2) == '{':
+                    entity = {}
+                    key = None
+                elif entity is not None:
+                    self.entities.append(entity)
+                    entity = None
+            elif entity is not None:
+                if key is None:
+                    key = quoted
+                else:
+                    entity[key] = quoted
+                    key = None
+        for i, entity in enumerate(self.entities):
+            for key in BSP_File.entity_keys:
+                if key in entity:
+                    self.entity_index[key].setdefault(entity[key], []).append(i)
+
+    def find_entities(self, key, value):
+        # entities with key set to value, keys in entity_keys are looked up
+        # in the index, anything else is a scan
+        if key in self.entity_index:
+            return [self.entities[i] for i in self.entity_index[key].get(value, [])]
+        return [e for e in self.entities if e.get(key) == value]
+
+    def entity_origins(self, classname):
+        # (N,3) origins of all entities of a class
+        origins = [e['origin'].split() for e in self.find_entities('classname', classname) if 'origin' in e]
+        return numpy.array(origins, numpy.float64).reshape(-1, 3)
+
+    def model_entity(self, model):
+        # the entity using brush model *model, None for the world or unused models
+        found = self.find_entities('model', "*%i" % model)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def read_texinfo(self):
+        if self.columnar:
+            self.texinfo = self.lump_array('texinfo')
+            return
+        self.texinfo = []
+        for data in self.read_records('texinfo'):
+            texinfo = {}
+            texinfo['s'] = (data[0], data[1], data[2])
+            texinfo['s_offset'] = data[3]
+            texinfo['t'] = (data[4], data[5], data[6])
+            texinfo['t_offset'] = data[7]
+            texinfo['miptex'] = data[8]
+            texinfo['flags'] = data[9]
+            self.texinfo.append(texinfo)
+
+    def read_lightmaps(self):
+        self.lightmaps = numpy.frombuffer(self.read_lump('lightmaps'), numpy.uint8)
+
+    def read_vislist(self):
+        self.vislist = str(self.read_lump('vislist'))
+
+    def read_miptex(self):
+        # texture directory, the offsets of the four mip levels are
+        # relative to the lump, textures missing from the file are None
+        self.miptex_data = numpy.frombuffer(self.read_lump('miptex'), numpy.uint8)
+        self.miptex = []
+        if len(self.miptex_data) < 4:
+            return
+        data = self.miptex_data
+        count = struct.unpack_from("i", data)[0]
+        for offset in struct.unpack_from("%ii" % count, data, 4):
+            if offset < 0:
+                self.miptex.append(None)
+                continue
+            m = struct.unpack_from("16sII4I", data, offset)
+            texture = {}
+            texture['name'] = m[0].split('\0')[0]
+            texture['width'] = m[1]
+            texture['height'] = m[2]
+            texture['offsets'] = [offset + o for o in m[3:7]]
+            self.miptex.append(texture)
+
+    def texture_levels(self, index):
+        # palette indices of the four mip levels as (height, width) arrays
+        texture = self.miptex[index]
+        levels = []
+        for level in range(4):
+            width = texture['width'] >> level
+            height = texture['height'] >> level
+            offset = texture['offsets'][level]
+            levels.append(self.miptex_data[offset:offset + width * height].reshape(height, width))
+        return levels
+
 
 
     def get_max(self):
-        limit = self.header['vertices']['num']
+        v = self.lump_array('vertices')
         self.minimum = [0, 0, 0]
         self.maximum = [0, 0, 0]
-        for i in range(limit):
-            for x in range(3):
-                if self.vertices[i][x] < self.minimum[x]:
-                    self.minimum[x] = self.vertices[i][x]
-                if self.vertices[i][x] > self.maximum[x]:
-                    self.maximum[x] = self.vertices[i][x]
-
+        if len(v):
+            self.minimum = numpy.minimum(v.min(axis=0), 0).tolist()
+            self.maximum = numpy.maximum(v.max(axis=0), 0).tolist()
+
+    def get_polygons(self):
+        # every face winding as a run of vertex ids, face i is
+        # polygon_vertices[polygon_offsets[i]:polygon_offsets[i + 1]]
+        faces = self.lump_array('faces')
+        ledges = self.lump_array('ledges')
+        edges = self.lump_array('edges')
+        count = faces['ledge_num'].astype(numpy.int32)
+        self.polygon_offsets = numpy.zeros(len(faces) + 1, numpy.int32)
+        numpy.cumsum(count, out=self.polygon_offsets[1:])
+        ledge = ledges[numpy.arange(self.polygon_offsets[-1], dtype=numpy.int32) +
+                numpy.repeat(faces['ledge_id'] - self.polygon_offsets[:-1], count)]
+        # a negative ledge walks its edge backwards
+        self.polygon_vertices = edges[numpy.abs(ledge), (ledge < 0).astype(numpy.int32)].astype(numpy.int32)
+
+    def face_windings(self, face_ids):
+        # offsets and vertex ids for a subset of the faces, same layout
+        # as polygon_offsets and polygon_vertices
+        start = self.polygon_offsets[face_ids]
+        count = self.polygon_offsets[numpy.asarray(face_ids) + 1] - start
+        offsets = numpy.zeros(len(count) + 1, numpy.int32)
+        numpy.cumsum(count, out=offsets[1:])
+        ids = numpy.arange(offsets[-1], dtype=numpy.int32) + numpy.repeat(start - offsets[:-1], count)
+        return offsets, self.polygon_vertices[ids]
+
+    def model_faces(self, model):
+        # faces of a model lying on the front side of their plane
+        m = self.lump_array('models')[model]
+        side = self.lump_array('faces')['side'][m['face_id']:m['face_id'] + m['face_num']]
+        return m['face_id'] + numpy.flatnonzero(side == 0)
+
+    def get_polygon_st(self):
+        # texture space s and t of every polygon vertex in texels, the
+        # vertex dotted with the s and t vectors of the face texinfo
+        faces = self.lump_array('faces')
+        texinfo = self.lump_array('texinfo')[faces['texinfo_id']]
+        vertices = self.lump_array('vertices')[self.polygon_vertices].astype(numpy.float64)
+        face = numpy.repeat(numpy.arange(len(faces)), numpy.diff(self.polygon_offsets))
+        self.polygon_st = numpy.empty((len(vertices), 2))
+        self.polygon_st[:, 0] = (vertices * texinfo['s'][face]).sum(axis=1) + texinfo['s_offset'][face]
+        self.polygon_st[:, 1] = (vertices * texinfo['t'][face]).sum(axis=1) + texinfo['t_offset'][face]
+
+    def get_uvs(self):
+        # texture coordinates of every polygon vertex, 1 is the width or
+        # height of the texture (textures missing from the file count as
+        # 1 texel)
+        faces = self.lump_array('faces')
+        face = numpy.repeat(numpy.arange(len(faces)), numpy.diff(self.polygon_offsets))
+        st = self.polygon_st
+
+        sizes = numpy.ones((len(self.miptex) + 1, 2))
+        for index, texture in enumerate(self.miptex):
+            if texture is not None and texture['width'] and texture['height']:
+                sizes[index] = (texture['width'], texture['height'])
+        miptex = self.lump_array('texinfo')['miptex'][faces['texinfo_id']].astype(numpy.int64)
+        miptex[miptex >= len(self.miptex)] = len(self.miptex)
+        self.polygon_uvs = st / sizes[miptex[face]]
+
+    def get_lightmap_uvs(self):
+        # every polygon vertex placed in lightmap_atlas with luxel centers
+        # like the engine samples them, -1 for faces without a lightmap
+        face = numpy.repeat(numpy.arange(len(self.polygon_offsets) - 1), numpy.diff(self.polygon_offsets))
+        st = self.polygon_st
+        self.polygon_lightmap_uvs = numpy.empty((len(st), 2))
+        self.polygon_lightmap_uvs.fill(-1)
+        rects = self.lightmap_rects
+        lit = numpy.flatnonzero(rects[face, 0] >= 0)
+        if len(lit):
+            luxel = (st[lit] + 8) / 16 - self.lightmap_mins[face[lit]]
+            atlas = numpy.array(self.lightmap_atlas.shape[::-1], numpy.float64)
+            self.polygon_lightmap_uvs[lit] = (rects[face[lit], :2] + luxel) / atlas
+
+    def get_lightmap_extents(self):
+        # luxel grid of every face like the engine computes it: texture
+        # coordinates of the winding snapped outwards to 16 units.
+        # lightmap_mins is the grid origin in luxels, lightmap_sizes the
+        # width and height, 0 for faces without a lightmap
+        faces = self.lump_array('faces')
+        texinfo = self.lump_array('texinfo')[faces['texinfo_id']]
+        st = self.polygon_st
+
+        self.lightmap_mins = numpy.zeros((len(faces), 2), numpy.int32)
+        self.lightmap_sizes = numpy.zeros((len(faces), 2), numpy.int32)
+        lit = (faces['lightmap'] != 0xffffffff) & (texinfo['flags'] & TEX_SPECIAL == 0) & (numpy.diff(self.polygon_offsets) > 0)
+        if not lit.any():
+            return
+        start = self.polygon_offsets[:-1][lit]
+        low = numpy.floor(numpy.minimum.reduceat(st, start) / 16).astype(numpy.int32)
+        high = numpy.ceil(numpy.maximum.reduceat(st, start) / 16).astype(numpy.int32)
+        self.lightmap_mins[lit] = low
+        self.lightmap_sizes[lit] = high - low + 1
+
+    def get_lightmap_atlas(self):
+        # packs the first light style of every lit face into one luxel
+        # atlas, rows of faces sorted by height (shelf packing).
+        # lightmap_rects holds x, y, width, height per face, -1 if unlit
+        faces = self.lump_array('faces')
+        size = self.lightmap_sizes
+        lit = numpy.flatnonzero(size[:, 0] > 0)
+        self.lightmap_rects = numpy.empty((len(faces), 4), numpy.int32)
+        self.lightmap_rects.fill(-1)
+        if len(lit) == 0:
+            self.lightmap_atlas = numpy.zeros((0, 0), numpy.uint8)
+            return
+
+        order = lit[numpy.lexsort((-size[lit, 0], -size[lit, 1]))]
+        w = size[order, 0].astype(numpy.int64)
+        h = size[order, 1].astype(numpy.int64)
+        area = (w * h).sum()
+        width = 1
+        while width * width < area:
+            width *= 2
+        width = max(width, w.max())
+
+        # fill shelves left to right, the first face of a shelf is the
+        # tallest one on it
+        end = numpy.cumsum(w)
+        x = numpy.empty(len(order), numpy.int64)
+        y = numpy.empty(len(order), numpy.int64)
+        start = 0
+        base = 0
+        top = 0
+        while start < len(order):
+            stop = numpy.searchsorted(end, base + width, 'right')
+            x[start:stop] = end[start:stop] - w[start:stop] - base
+            y[start:stop] = top
+            top += h[start]
+            base = end[stop - 1]
+            start = stop
+        self.lightmap_rects[order] = numpy.column_stack((x, y, w, h))
+
+        # copy all luxels with one gather
+        count = w * h
+        local = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+        face = numpy.repeat(numpy.arange(len(order)), count)
+        source = faces['lightmap'][order].astype(numpy.int64)[face] + local
+        target = (y[face] + local // w[face]) * width + x[face] + local % w[face]
+        valid = source < len(self.lightmaps)
+        self.lightmap_atlas = numpy.zeros((top, width), numpy.uint8)
+        self.lightmap_atlas.flat[target[valid]] = self.lightmaps[source[valid]]
+
+    def get_face_bounds(self):
+        # bounding box of every face, faces without edges get an empty box
+        offsets = self.polygon_offsets
+        count = len(offsets) - 1
+        self.face_mins = numpy.empty((count, 3), numpy.float32)
+        self.face_mins.fill(numpy.inf)
+        self.face_maxs = numpy.empty((count, 3), numpy.float32)
+        self.face_maxs.fill(-numpy.inf)
+        used = numpy.flatnonzero(numpy.diff(offsets) > 0)
+        if len(used):
+            points = self.lump_array('vertices')[self.polygon_vertices]
+            self.face_mins[used] = numpy.minimum.reduceat(points, offsets[used], axis=0)
+            self.face_maxs[used] = numpy.maximum.reduceat(points, offsets[used], axis=0)
+
+    def get_bvh(self):
+        # complete binary tree over the faces, node i has the children
+        # 2i + 1 and 2i + 2 and the last half of the nodes are leaves
+        # holding bvh_leaf_size faces each (-1 pads them). Level by level
+        # the faces of every node are sorted along the axis their centers
+        # spread most on, each half going to one child.
+        mins = self.face_mins
+        maxs = self.face_maxs
+        count = len(mins)
+        leaf = BSP_File.bvh_leaf_size
+        size = 1
+        while size * leaf < count:
+            size *= 2
+
+        # padding sorts last and does not widen the spread
+        centers = (mins.astype(numpy.float64) + maxs) / 2
+        centers[~numpy.isfinite(centers)] = 0
+        low = numpy.vstack((centers, numpy.full((1, 3), numpy.inf)))
+        high = numpy.vstack((centers, numpy.full((1, 3), -numpy.inf)))
+        order = numpy.empty(size * leaf, numpy.int32)
+        order.fill(count)
+        order[:count] = numpy.arange(count)
+        span = size * leaf
+        while span > leaf:
+            segment = numpy.arange(len(order)) / span
+            starts = numpy.arange(0, len(order), span)
+            spread = numpy.maximum.reduceat(high[order], starts) - numpy.minimum.reduceat(low[order], starts)
+            axis = numpy.argmax(spread, axis=1)[segment]
+            key = low[order, axis]
+            order = order[numpy.lexsort((key, segment))]
+            span /= 2
+        order[order == count] = -1
+        self.bvh_faces = order
+
+        # the -1 of the padding picks the empty box appended last
+        bounds_min = numpy.vstack((mins, numpy.full((1, 3), numpy.inf, numpy.float32)))
+        bounds_max = numpy.vstack((maxs, numpy.full((1, 3), -numpy.inf, numpy.float32)))
+        self.bvh_mins = numpy.empty((2 * size - 1, 3), numpy.float32)
+        self.bvh_maxs = numpy.empty((2 * size - 1, 3), numpy.float32)
+        self.bvh_mins[size - 1:] = bounds_min[self.bvh_faces].reshape(size, leaf, 3).min(axis=1)
+        self.bvh_maxs[size - 1:] = bounds_max[self.bvh_faces].reshape(size, leaf, 3).max(axis=1)
+        while size > 1:
+            parents = numpy.arange(size / 2 - 1, size - 1)
+            self.bvh_mins[parents] = numpy.minimum(self.bvh_mins[2 * parents + 1], self.bvh_mins[2 * parents + 2])
+            self.bvh_maxs[parents] = numpy.maximum(self.bvh_maxs[2 * parents + 1], self.bvh_maxs[2 * parents + 2])
+            size /= 2
+
+    def faces_in_boxes(self, mins, maxs):
+        # faces whose bounds overlap each of the (N,3) boxes, box i holds
+        # faces[offsets[i]:offsets[i + 1]]. All boxes walk the tree
+        # together and only visit nodes they overlap.
+        mins = numpy.asarray(mins, numpy.float64).reshape(-1, 3)
+        maxs = numpy.asarray(maxs, numpy.float64).reshape(-1, 3)
+        leaves = (len(self.bvh_mins) + 1) / 2
+        query = numpy.arange(len(mins))
+        node = numpy.zeros(len(mins), numpy.int32)
+        while True:
+            overlap = ((self.bvh_mins[node] <= maxs[query]) & (self.bvh_maxs[node] >= mins[query])).all(axis=1)
+            query = query[overlap]
+            node = node[overlap]
+            # every leaf is on the same level
+            if len(node) == 0 or node[0] >= leaves - 1:
+                break
+            query = numpy.repeat(query, 2)
+            node = (2 * node[:, numpy.newaxis] + [1, 2]).ravel()
+
+        leaf = BSP_File.bvh_leaf_size
+        faces = self.bvh_faces.reshape(-1, leaf)[node - (leaves - 1)].ravel()
+        query = numpy.repeat(query, leaf)
+        keep = faces >= 0
+        query = query[keep]
+        faces = faces[keep]
+        keep = ((self.face_mins[faces] <= maxs[query]) & (self.face_maxs[faces] >= mins[query])).all(axis=1)
+        query = query[keep]
+        faces = faces[keep]
+        order = numpy.lexsort((faces, query))
+        offsets = numpy.zeros(len(mins) + 1, numpy.int32)
+        numpy.cumsum(numpy.bincount(query, minlength=len(mins)), out=offsets[1:])
+        return offsets, faces[order]
+
+    def faces_in_region(self, mins, maxs):
+        # faces overlapping each of the (N,2) rectangles seen from above
+        mins = numpy.asarray(mins, numpy.float64).reshape(-1, 2)
+        maxs = numpy.asarray(maxs, numpy.float64).reshape(-1, 2)
+        low = numpy.empty((len(mins), 1))
+        low.fill(-numpy.inf)
+        return self.faces_in_boxes(numpy.hstack((mins, low)), numpy.hstack((maxs, -low)))
+
+    def face_distance(self, points, faces):
+        # squared distance from each of the (M,3) points to the matching
+        # convex face and the closest point on it
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+        vertices = self.lump_array('vertices')
+        start = self.polygon_offsets[faces]
+        count = self.polygon_offsets[numpy.asarray(faces) + 1] - start
+        distance = numpy.empty(len(points))
+        distance.fill(numpy.inf)
+        closest = numpy.zeros((len(points), 3))
+        if count.sum() == 0:
+            return distance, closest
+        row = numpy.cumsum(count) - count
+        pair = numpy.repeat(numpy.arange(len(points)), count)
+        local = numpy.arange(count.sum()) - numpy.repeat(row, count)
+        first = numpy.repeat(start, count)
+        a = vertices[self.polygon_vertices[first + local]].astype(numpy.float64)
+        b = vertices[self.polygon_vertices[first + (local + 1) % numpy.repeat(count, count)]].astype(numpy.float64)
+        p = points[pair]
+
+        # nearest point on every edge
+        ab = b - a
+        t = ((p - a) * ab).sum(axis=1) / numpy.maximum((ab * ab).sum(axis=1), 1e-12)
+        edge_points = a + numpy.clip(t, 0, 1)[:, numpy.newaxis] * ab
+        d2 = ((p - edge_points) ** 2).sum(axis=1)
+        # the edges of a point are one run, keep the first nearest of each
+        used = numpy.flatnonzero(count > 0)
+        distance[used] = numpy.minimum.reduceat(d2, row[used])
+        nearest = numpy.flatnonzero(d2 == distance[pair])
+        nearest = nearest[::-1]
+        closest[pair[nearest]] = edge_points[nearest]
+
+        # points above the inside of a face are nearest to its plane, the
+        # normal follows the winding
+        normal = numpy.zeros((len(points), 3))
+        normal[used] = numpy.add.reduceat(numpy.cross(a, b), row[used], axis=0)
+        outside = (numpy.cross(ab, p - a) * normal[pair]).sum(axis=1) < 0
+        inside = numpy.bincount(pair, outside, len(points)) == 0
+        length = numpy.sqrt((normal ** 2).sum(axis=1))
+        inside &= length > 0
+        i = numpy.flatnonzero(inside)
+        unit = normal[i] / length[i, numpy.newaxis]
+        height = ((points[i] - a[row[i]]) * unit).sum(axis=1)
+        distance[i] = height ** 2
+        closest[i] = points[i] - height[:, numpy.newaxis] * unit
+        return distance, closest
+
+    def nearest_surface(self, points):
+        # nearest face to each of the (N,3) points, the nearest point on
+        # it and the distance, the face is -1 if the map has none. All
+        # points walk the tree together. Every side of a node box touches
+        # one of its faces, so no face of a node can be nearer than its
+        # box and one is at most the min max distance of the box away,
+        # nodes further than the best such bound of their point are
+        # dropped.
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+        count = len(points)
+        face = numpy.empty(count, numpy.int32)
+        face.fill(-1)
+        closest = numpy.zeros((count, 3))
+        bound = numpy.empty(count)
+        bound.fill(numpy.inf)
+        leaves = (len(self.bvh_mins) + 1) / 2
+        if count == 0:
+            return face, closest, bound
+
+        query = numpy.arange(count)
+        node = numpy.zeros(count, numpy.int32)
+        while len(query):
+            low = self.bvh_mins[node]
+            high = self.bvh_maxs[node]
+            p = points[query]
+            d = numpy.maximum(low - p, 0) + numpy.maximum(p - high, 0)
+            near = (d * d).sum(axis=1)
+            # nearer and farther side of the box on every axis
+            side = numpy.minimum((p - low) ** 2, (p - high) ** 2)
+            far = numpy.maximum((p - low) ** 2, (p - high) ** 2)
+            with numpy.errstate(invalid='ignore'):
+                minmax = (far.sum(axis=1)[:, numpy.newaxis] - far + side).min(axis=1)
+            # nodes holding only padding have no faces to bound with
+            minmax[numpy.isnan(minmax)] = numpy.inf
+            numpy.minimum.at(bound, query, minmax)
+            keep = near <= bound[query]
+            query = query[keep]
+            node = node[keep]
+            near = near[keep]
+            # every leaf is on the same level
+            if len(node) == 0 or node[0] >= leaves - 1:
+                break
+            query = numpy.repeat(query, 2)
+            node = (2 * node[:, numpy.newaxis] + [1, 2]).ravel()
+
+        # the nearest leaf of every point first, then the leaves that can
+        # still hold something nearer than what it gave
+        best = numpy.empty(count)
+        best.fill(numpy.inf)
+        leaf = BSP_File.bvh_leaf_size
+        order = numpy.lexsort((near, query))
+        first = numpy.zeros(len(order), numpy.bool_)
+        first[:1] = True
+        first[1:] = query[order][1:] != query[order][:-1]
+        for batch in (order[first], order[~first]):
+            batch = batch[near[batch] <= best[query[batch]]]
+            faces = self.bvh_faces.reshape(-1, leaf)[node[batch] - (leaves - 1)].ravel()
+            pairs = numpy.repeat(query[batch], leaf)
+            keep = faces >= 0
+            pairs = pairs[keep]
+            faces = faces[keep]
+            if len(faces) == 0:
+                continue
+            d2, nearest = self.face_distance(points[pairs], faces)
+            order = numpy.lexsort((d2, pairs))
+            pick = order[numpy.concatenate(([True], pairs[order][1:] != pairs[order][:-1]))]
+            pick = pick[d2[pick] < best[pairs[pick]]]
+            best[pairs[pick]] = d2[pick]
+            face[pairs[pick]] = faces[pick]
+            closest[pairs[pick]] = nearest[pick]
+        return face, closest, numpy.sqrt(best)
+
+    def get_node_table(self):
+        # children are signed shorts on disk, a negative child c is leaf -(c + 1)
+        nodes = self.lump_array('nodes')
+        self.node_planes = nodes['plane_id'].astype(numpy.int32)
+        self.node_children = numpy.column_stack((nodes['front'], nodes['back'])).astype(numpy.int32)
+
+    def get_clip_table(self):
+        # a negative clipnode child is the contents of that side itself
+        clipnodes = self.lump_array('clipnodes')
+        self.clip_planes = clipnodes['plane_id'].astype(numpy.int32)
+        self.clip_children = numpy.column_stack((clipnodes['front'], clipnodes['back'])).astype(numpy.int32)
+
+    def point_leaf(self, points, model=0):
+        # leaf containing each of the (N,3) points, all points go down the
+        # tree together, one level per step
+        points = numpy.asarray(points, numpy.float64).reshape(-1, 3)
+        planes = self.lump_array('planes')
+        node = numpy.empty(len(points), numpy.int32)
+        node.fill(self.lump_array('models')[model]['node_id0'])
+        active = numpy.flatnonzero(node >= 0)
+        while len(active):
+            n = node[active]
+            p = self.node_planes[n]
+            d = (points[active] * planes['normal'][p]).sum(axis=1) - planes['dist'][p]
+            node[active] = self.node_children[n, (d <= 0).astype(numpy.int32)]
+            active = active[node[active] >= 0]
+        return -(node + 1)
+
+    def leaf_visibility(self, leaf):
+        # run length decoded visibility row of a leaf, bit i of the packed
+        # row is set if leaf i + 1 can be seen from it
+        row = self.vis_cache.get(leaf)
+        if row is None:
+            row = self.decompress_vis(int(self.lump_array('leaves')['vistlist'][leaf]))
+            self.vis_cache.put(leaf, row)
+        return row
+
+    def decompress_vis(self, offset):
+        row_size = (self.lump_array('models')[0]['numleaves'] + 7) >> 3
+        if offset < 0:
+            # no vis data, everything can be seen
+            row = numpy.empty(row_size, numpy.uint8)
+            row.fill(255)
+            return row
+        data = self.vislist
+        row = []
+        size = 0
+        while size < row_size:
+            # copy literal bytes up to the next zero, a zero is followed by
+            # the number of zero bytes it stands for
+            end = data.find('\0', offset, offset + row_size - size)
+            if end < 0:
+                end = min(offset + row_size - size, len(data))
+            if end > offset:
+                row.append(data[offset:end])
+                size += end - offset
+                offset = end
+            if size < row_size:
+                if offset + 1 >= len(data):
+                    break
+                zeros = min(ord(data[offset + 1]), row_size - size)
+                row.append('\0' * zeros)
+                size += zeros
+                offset += 2
+        row = ''.join(row)
+        return numpy.fromstring(row + '\0' * (row_size - len(row)), numpy.uint8)
+
+    def vis_matrix(self):
+        # packed visibility rows of every leaf, one row per leaf index
+        leaves = self.lump_array('leaves')
+        rows = {}
+        matrix = numpy.empty((len(leaves), (self.lump_array('models')[0]['numleaves'] + 7) >> 3), numpy.uint8)
+        for leaf, offset in enumerate(leaves['vistlist'].tolist()):
+            # leaves sharing a row share the decoding
+            if offset not in rows:
+                rows[offset] = self.decompress_vis(offset)
+            matrix[leaf] = rows[offset]
+        return matrix
+
+    def visible_leaves(self, leaf):
+        row = self.leaf_visibility(leaf)
+        bits = numpy.unpackbits(row.reshape(-1, 1), axis=1)[:, ::-1].ravel()
+        return numpy.flatnonzero(bits[:self.lump_array('models')[0]['numleaves']]) + 1
+
+    def visible_faces(self, leaf):
+        # faces listed by the leaves visible from a leaf
+        leaves = self.lump_array('leaves')[self.visible_leaves(leaf)]
+        count = leaves['face_num'].astype(numpy.int64)
+        ids = numpy.arange(count.sum()) + numpy.repeat(leaves['face_id'] - (numpy.cumsum(count) - count), count)
+        return numpy.unique(self.lump_array('lface')[ids])
+
+    def trace_nodes(self, starts, ends, head, plane_ids, children, solid):
+        # walks segments down a node table without recursion. Every piece of
+        # a segment lying on both sides of a plane is split in two and all
+        # pieces advance one level per step, pieces behind the first solid
+        # hit of their segment are dropped. Returns, per segment, the
+        # fraction where it first enters a terminal for which solid() is
+        # true (1 if none), the plane crossed there (-1 if none or if the
+        # segment starts inside), whether that plane was crossed from its
+        # back and the terminal hit (0 if none).
+        planes = self.lump_array('planes')
+        delta = ends - starts
+        count = len(starts)
+        fraction = numpy.ones(count)
+        hit_plane = numpy.empty(count, numpy.int32)
+        hit_plane.fill(-1)
+        hit_back = numpy.zeros(count, numpy.bool_)
+        hit_terminal = numpy.zeros(count, numpy.int32)
+
+        seg = numpy.arange(count)
+        node = numpy.empty(count, numpy.int32)
+        node.fill(head)
+        t0 = numpy.zeros(count)
+        t1 = numpy.ones(count)
+        plane = numpy.empty(count, numpy.int32)
+        plane.fill(-1)
+        back = numpy.zeros(count, numpy.bool_)
+
+        while len(seg):
+            terminal = node < 0
+            hit = numpy.flatnonzero(terminal)
+            hit = hit[solid(node[hit])]
+            if len(hit):
+                numpy.minimum.at(fraction, seg[hit], t0[hit])
+                hit = hit[t0[hit] <= fraction[seg[hit]]]
+                hit_plane[seg[hit]] = plane[hit]
+                hit_back[seg[hit]] = back[hit]
+                hit_terminal[seg[hit]] = node[hit]
+
+            keep = ~terminal & (t0 < fraction[seg])
+            seg, node, t0, t1, plane, back = seg[keep], node[keep], t0[keep], t1[keep], plane[keep], back[keep]
+
+            p = plane_ids[node]
+            normal = planes['normal'][p]
+            dist = planes['dist'][p]
+            d0 = ((starts[seg] + t0[:, numpy.newaxis] * delta[seg]) * normal).sum(axis=1) - dist
+            d1 = ((starts[seg] + t1[:, numpy.newaxis] * delta[seg]) * normal).sum(axis=1) - dist
+
+            # pieces entirely on one side just move to that child
+            side = (d0 < 0).astype(numpy.int32)
+            cross = (d0 < 0) != (d1 < 0)
+            whole = ~cross
+            near = children[node, side]
+            far = children[node, 1 - side]
+
+            c = numpy.flatnonzero(cross)
+            middle = d0[c] / (d0[c] - d1[c])
+            seg = numpy.concatenate((seg[whole], seg[c], seg[c]))
+            node = numpy.concatenate((near[whole], near[c], far[c]))
+            t0, t1 = (numpy.concatenate((t0[whole], t0[c], t0[c] + middle * (t1[c] - t0[c]))),
+                    numpy.concatenate((t1[whole], t0[c] + middle * (t1[c] - t0[c]), t1[c])))
+            plane = numpy.concatenate((plane[whole], plane[c], p[c]))
+            back = numpy.concatenate((back[whole], back[c], side[c] == 1))
+
+        return fraction, hit_plane, hit_back, hit_terminal
+
+    def trace_line(self, starts, ends, model=0):
+        # first solid leaf hit by each segment from the (N,3) starts to the
+        # (N,3) ends: the fraction of the segment travelled (1 if nothing
+        # is hit), the end positions and the leaf hit (-1 if none)
+        starts = numpy.asarray(starts, numpy.float64).reshape(-1, 3)
+        ends = numpy.asarray(ends, numpy.float64).reshape(-1, 3)
+        contents = self.lump_array('leaves')['type']
+        fraction, plane, back, terminal = self.trace_nodes(starts, ends,
+                self.lump_array('models')[model]['node_id0'],
+                self.node_planes, self.node_children,
+                lambda c: contents[-(c + 1)] == CONTENTS_SOLID)
+        endpos = starts + fraction[:, numpy.newaxis] * (ends - starts)
+        return fraction, endpos, numpy.where(terminal < 0, -(terminal + 1), -1)
+
+    def trace_hull(self, starts, ends, hull=1, model=0):
+        # moves the box of a hull (1 player sized, 2 large monsters) from
+        # the (N,3) starts to the (N,3) ends through the clipnodes. The
+        # points are entity origins like the engine traces them, not box
+        # centers, the player box is -16..16 by -24..32 around it. Returns
+        # the fraction travelled, the end positions, the plane hit (-1 if
+        # none or if the trace starts in solid) and its normal facing the
+        # start (0 if none).
+        if hull not in (1, 2):
+            # hull 0 is the point hull of the bsp nodes, see trace_line
+            raise ValueError("no clipping hull %r, only 1 and 2" % (hull,))
+        starts = numpy.asarray(starts, numpy.float64).reshape(-1, 3)
+        ends = numpy.asarray(ends, numpy.float64).reshape(-1, 3)
+        fraction, plane, back, terminal = self.trace_nodes(starts, ends,
+                self.lump_array('models')[model]['node_id%i' % hull],
+                self.clip_planes, self.clip_children,
+                lambda c: c == CONTENTS_SOLID)
+
+        normal = numpy.zeros((len(starts), 3))
+        hit = numpy.flatnonzero(plane >= 0)
+        normal[hit] = self.lump_array('planes')['normal'][plane[hit]]
+        normal[hit[back[hit]]] *= -1
+        # stop short of the plane so the end is outside of the solid
+        speed = -(normal[hit] * (ends[hit] - starts[hit])).sum(axis=1)
+        fraction[hit] = numpy.maximum(fraction[hit] - DIST_EPSILON / numpy.maximum(speed, 1e-9), 0)
+        endpos = starts + fraction[:, numpy.newaxis] * (ends - starts)
+        return fraction, endpos, plane, normal
+
+
+
+def profiled(method):
+    # records the time, the bytes read and the lump records of a loader
+    # while a profile is recorded, loaders reading others nest
+    def run(self, *args):
+        if profile is None:
+            return method(self, *args)
+        start = time.time()
+        bytes_read = self.bytes_read
+        result = method(self, *args)
+        records = None
+        if method.__name__.startswith('read_'):
+            records = self.header.get(method.__name__[5:], {}).get('num')
+        profile_stage(method.__name__, start, bytes=self.bytes_read - bytes_read,
+                records=records)
+        return result
+    run.__name__ = method.__name__
+    return run
+
+for name in set(BSP_File.loaders.values()) | set(('read_header', 'load_cache', 'save_cache')):
+    setattr(BSP_File, name, profiled(getattr(BSP_File, name).im_func))
+
+
+class BSP_Writer:
+    # writes a map from the lumps of a BSP_File. Lumps can be replaced or
+    # removed and the unreferenced vertices, edges and planes dropped
+    # before, every lump is written with one call.
+    def __init__(self, f):
+        self.version = f.header['version']
+        self.lumps = {}
+        for name in BSP_File.lump_order:
+            if name in BSP_File.dtypes:
+                self.lumps[name] = f.lump_array(name).copy()
+            else:
+                self.lumps[name] = str(f.read_lump(name))
+
+    def replace(self, name, data):
+        # data is a record array of the lump or its bytes
+        if name in BSP_File.dtypes and not isinstance(data, str):
+            # vertices and edges are plain (N,3) and (N,2) arrays
+            dtype = BSP_File.dtypes[name]
+            data = numpy.asarray(data, (dtype.subdtype or (dtype,))[0])
+        self.lumps[name] = data
+
+    def remove(self, name):
+        # an empty lump, what points into visibility or lighting data is
+        # set to none like the compilers do without them
+        if name in BSP_File.dtypes:
+            self.lumps[name] = self.lumps[name][:0]
+        else:
+            self.lumps[name] = ''
+        if name == 'vislist':
+            self.lumps['leaves']['vistlist'] = -1
+        elif name == 'lightmaps':
+            self.lumps['faces']['lightmap'] = 0xffffffff
+
+    def compact(self):
+        # rebuilds ledges as the runs of the faces in face order, then keeps
+        # only the edges, vertices and planes still used, returns the
+        # (before, after) record counts
+        faces = self.lumps['faces']
+        ledges = self.lumps['ledges']
+        edges = self.lumps['edges']
+        vertices = self.lumps['vertices']
+        planes = self.lumps['planes']
+        counts = {}
+
+        count = faces['ledge_num'].astype(numpy.int64)
+        offsets = numpy.zeros(len(faces) + 1, numpy.int64)
+        numpy.cumsum(count, out=offsets[1:])
+        ledges = ledges[numpy.arange(offsets[-1]) + numpy.repeat(faces['ledge_id'] - offsets[:-1], count)]
+        counts['ledges'] = (len(self.lumps['ledges']), len(ledges))
+        faces['ledge_id'] = offsets[:-1]
+
+        # edge 0 stays first, a negative ledge can not name it
+        keep = numpy.union1d([0], numpy.abs(ledges))
+        remap = numpy.zeros(len(edges), numpy.int64)
+        remap[keep] = numpy.arange(len(keep))
+        ledges = (numpy.sign(ledges) * remap[numpy.abs(ledges)]).astype(ledges.dtype)
+        edges = edges[keep]
+        counts['edges'] = (len(remap), len(edges))
+
+        keep = numpy.unique(edges)
+        remap = numpy.zeros(len(vertices), numpy.int64)
+        remap[keep] = numpy.arange(len(keep))
+        edges = remap[edges].astype(edges.dtype)
+        counts['vertices'] = (len(vertices), len(keep))
+        vertices = vertices[keep]
+
+        nodes = self.lumps['nodes']
+        clipnodes = self.lumps['clipnodes']
+        keep = numpy.unique(numpy.concatenate((faces['plane_id'], nodes['plane_id'], clipnodes['plane_id'])))
+        remap = numpy.zeros(len(planes), numpy.int64)
+        remap[keep] = numpy.arange(len(keep))
+        faces['plane_id'] = remap[faces['plane_id']]
+        nodes['plane_id'] = remap[nodes['plane_id']]
+        clipnodes['plane_id'] = remap[clipnodes['plane_id']]
+        counts['planes'] = (len(planes), len(keep))
+
+        self.lumps['ledges'] = ledges
+        self.lumps['edges'] = edges
+        self.lumps['vertices'] = vertices
+        self.lumps['planes'] = planes[keep]
+        return counts
+
+    def write(self, filename):
+        # lumps in the usual order, 4 byte aligned, into a temporary file
+        # renamed over filename so readers never see half a map
+        data = []
+        header = [self.version]
+        offset = 4 + 8 * len(BSP_File.lump_order)
+        for name in BSP_File.lump_order:
+            lump = self.lumps[name]
+            if not isinstance(lump, str):
+                lump = lump.tostring()
+            data.append(lump + '\0' * (-len(lump) % 4))
+            header.extend((offset, len(lump)))
+            offset += len(data[-1])
+        temporary = "%s.%i" % (filename, os.getpid())
+        out = open(temporary, "wb")
+        out.write(struct.pack("<%iI" % len(header), *header))
+        for lump in data:
+            out.write(lump)
+        out.close()
+        os.rename(temporary, filename)
+        return offset
+
+
+class PAK_File:
+    # directory of a pak archive, members are read in place from a read
+    # only mapping of the archive
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb', 0)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < 12 or self.map[:4] != "PACK":
+            raise IOError("\"%s\" is not a pak file" % filename)
+        offset, size = struct.unpack_from("<ii", self.map, 4)
+        if offset < 0 or size < 0 or offset + size > len(self.map):
+            raise IOError("\"%s\" has a broken directory" % filename)
+
+        # 64 byte entries, a nul padded name, offset and size
+        self.entries = []
+        self.index = {}
+        for i in range(size / 64):
+            name, start, length = struct.unpack_from("<56sii", self.map, offset + i * 64)
+            entry = {'name': name.split('\0', 1)[0], 'offset': start, 'size': length}
+            if start < 0 or length < 0 or start + length > len(self.map):
+                raise IOError("\"%s\" in \"%s\" is out of bounds" % (entry['name'], filename))
+            self.entries.append(entry)
+            self.index[entry['name']] = entry
+
+    def find(self, pattern=None):
+        # names matching the regexp, in the order they are stored
+        entries = self.entries
+        if pattern is not None:
+            regexp = re.compile(pattern)
+            entries = [e for e in entries if regexp.search(e['name'])]
+        return [e['name'] for e in sorted(entries, key=lambda e: e['offset'])]
+
+    def read(self, name):
+        entry = self.index[name]
+        return buffer(self.map, entry['offset'], entry['size'])
+
+    def open_map(self, name, use_mmap=False, lazy=False, columnar=False, cache_dir=None):
+        entry = self.index[name]
+        return BSP_File(self.filename, use_mmap, lazy, columnar, cache_dir,
+                entry['offset'], entry['size'])
+
+# archives indexed by this process
+pak_files = {}
+
+def open_pak(filename):
+    if filename not in pak_files:
+        pak_files[filename] = PAK_File(filename)
+    return pak_files[filename]
+
+def split_member(name):
+    # "archive.pak:maps/e1m1.bsp" names a map inside an archive
+    if ':' in name:
+        pakfile, member = name.split(':', 1)
+        if pakfile.lower().endswith(".pak") and os.path.isfile(pakfile):
+            return pakfile, member
+    return None, name
+
+def open_map(name, use_mmap=False, lazy=False, columnar=False, cache_dir=None):
+    pakfile, member = split_member(name)
+    if pakfile is None:
+        return BSP_File(name, use_mmap, lazy, columnar, cache_dir)
+    pak = open_pak(pakfile)
+    if member not in pak.index:
+        raise IOError("no \"%s\" in \"%s\"" % (member, pakfile))
+    return pak.open_map(member, use_mmap, lazy, columnar, cache_dir)
+
+def output_name(name, extension):
+    # next to a loose map, or under the directory of the archive holding it
+    pakfile, member = split_member(name)
+    if pakfile is None:
+        return os.path.splitext(name)[0] + extension
+    outputfile = os.path.join(os.path.dirname(pakfile), os.path.splitext(member)[0] + extension)
+    if not os.path.isdir(os.path.dirname(outputfile) or '.'):
+        try:
+            os.makedirs(os.path.dirname(outputfile))
+        except OSError:
+            # another worker made it first
+            pass
+    return outputfile
 
 
 def check_normal(n):
@@ -382,421 +1665,1261 @@ def check_normal(n):
     return False
 
 
-
-
-
-
-
-
-f = BSP_File(ifile)
-
-if f.invalid == True:
-    print f.error
-    sys.exit()
-
-print "Filesize: %i" % f.filesize
-print f.header['models']['num']
-
-print f.models[0]['bounding_box']
-print f.models[0]['origin']
-
-
-rs = vec3(f.models[0]['bounding_box'][1]) - vec3(f.models[0]['bounding_box'][0])
-rs = rs + f.models[0]['origin']
-b = f.models[0]['bounding_box'][0]
-os = vec3(-b[0], -b[1], -b[2])
-
-print "rs: " + str(rs)
-print os
-
-m_max = vec3(-9999, -9999, -9999)
-m_min = vec3(9999, 9999, 9999)
-
-min_f = f.models[0]['face_id']
-max_f = f.models[0]['face_num'] + min_f
-for i in range(min_f, max_f):
-    n = vec3(f.planes[f.faces[i]['plane_id']]['normal'])
-    if (check_normal(n) and f.faces[i]['side'] == 0):
-        y = f.faces[i]['ledge_id']
-        for x in range(f.faces[i]['ledge_num'] - 1):
-            ledge = abs(f.ledges[x + y][0])
-            if (f.ledges[x+y][0] > 0):
-                v1 = vec3(f.vertices[f.edges[ledge][0]])
-                v2 = vec3(f.vertices[f.edges[ledge][1]])
-            else:
-                v1 = vec3(f.vertices[f.edges[ledge][1]])
-                v2 = vec3(f.vertices[f.edges[ledge][0]])
-
-            for t in range(0, 3):
-                if (v1[t] > m_max[t]):
-                    m_max[t] = v1[t]
-                if (v1[t] < m_min[t]):
-                    m_min[t] = v1[t]
-                if (v2[t] > m_max[t]):
-                    m_max[t] = v2[t]
-                if (v2[t] < m_min[t]):
-                    m_min[t] = v2[t]
-
-print "max: " + str(m_max)
-print "min: " + str(m_min)
-
-os = m_max - m_min
-
-width = os[0]
-height = os[1]
-scale = os[2]
-
-if width > height:
-    size = width
-else:
-    size = height
-
-size = int(size)
-
-print "width: " + str(width)
-print "height: " + str(height)
-
-glutInit(("none"))
-glutCreateWindow("test")
-
-# create FBO and bind it (that is, use offscreen render target)
-fb = glGenFramebuffersEXT(1)
-glBindFramebufferEXT(GL_FRAMEBUFFER_EXT,fb)
-
-# create texture
-tex = glGenTextures(1)
-glBindTexture(GL_TEXTURE_RECTANGLE_ARB,tex)
-glMatrixMode(GL_PROJECTION)
-glLoadIdentity()
-glViewport(0,0,int(width),int(height))
-glOrtho(0,int(width), int(height), 0, -99999, 99999)
-glMatrixMode(GL_MODELVIEW)
-glLoadIdentity()
-
-# set texture parameters
-glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_WRAP_S, GL_CLAMP)
-glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_WRAP_T, GL_CLAMP)
-
-# define texture with floating point format
-glTexImage2D(GL_TEXTURE_RECTANGLE_ARB,0,GL_RGBA, size,size,0,GL_RGBA,GL_UNSIGNED_BYTE,None)
-
-# attach texture
-glFramebufferTexture2DEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_TEXTURE_RECTANGLE_ARB,tex,0)
-# and read back
-
-glClearColor(0, 0, 0, 0)
-glClearDepth(0)
-glClear(GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
-glEnable(GL_BLEND)
-glEnable(GL_DEPTH_TEST)
-glEnable(GL_ALPHA_TEST)
-glDepthFunc(GL_GEQUAL)
-glCullFace(GL_FRONT)
-
-glDrawBuffer(GL_COLOR_ATTACHMENT0_EXT)
-glReadBuffer(GL_COLOR_ATTACHMENT0_EXT)
-
-glBindTexture(GL_TEXTURE_RECTANGLE_ARB, 0)
-glDisable(GL_TEXTURE_2D)
-
-glColor4f(1, 1, 1, 1)
-
-glTranslatef(-m_min[0], -m_min[1], 0)
-
-glLineWidth(4)
-for i in range(f.header['edges']['num']-1):
-    v1 = vec3(f.vertices[f.edges[i][0]])
-    v2 = vec3(f.vertices[f.edges[i][1]])
-    a1 = (v1[2] + f.minimum[2])/scale
-    a2 = (v2[2] + f.minimum[2])/scale
-    a2 = 0;
-    a1 = 0;
-    glBegin(GL_LINES)
-    glColor4f(a1, a1, a1, 1)
-    glVertex3f(v1[0], v1[1], v1[2])
-    glColor4f(a2, a2, a2, 1)
-    glVertex3f(v2[0], v2[1], v2[2])
+def fan_triangles(offsets):
+    # fan triangulation of convex windings stored in the polygon_offsets
+    # layout, returns (N,3) positions into the winding array
+    count = numpy.maximum(numpy.diff(offsets) - 2, 0)
+    first = numpy.repeat(offsets[:-1], count)
+    step = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+    return numpy.column_stack((first, first + step + 1, first + step + 2))
+
+
+# candidate pixels tested per batch by the software rasterizer
+raster_batch = 1 << 21
+
+def batches(count):
+    # split a run of items into consecutive slices holding about
+    # raster_batch units of work each
+    end = numpy.cumsum(count)
+    start = 0
+    while start < len(count):
+        stop = numpy.searchsorted(end, end[start] - count[start] + raster_batch, 'right')
+        stop = max(stop, start + 1)
+        yield start, stop
+        start = stop
+
+def raster_triangles(image, zbuffer, x, y, z, shade):
+    # x, y, z and shade are (N,3) pixel space corners of the triangles,
+    # pixels are sampled at their centers, the highest z wins and later
+    # triangles win ties
+    height, width = zbuffer.shape
+    x0 = numpy.clip(numpy.floor(x.min(axis=1)), 0, width).astype(numpy.int64)
+    x1 = numpy.clip(numpy.ceil(x.max(axis=1)), 0, width).astype(numpy.int64)
+    y0 = numpy.clip(numpy.floor(y.min(axis=1)), 0, height).astype(numpy.int64)
+    y1 = numpy.clip(numpy.ceil(y.max(axis=1)), 0, height).astype(numpy.int64)
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    box = numpy.where(area != 0, x1 - x0, 0)
+    count = box * (y1 - y0)
+    pixels = image.reshape(-1, 4)
+    for a, b in batches(count):
+        n = count[a:b]
+        t = numpy.repeat(numpy.arange(a, b), n)
+        local = numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+        px = x0[t] + local % box[t]
+        py = y0[t] + local // box[t]
+        cx = px + 0.5
+        cy = py + 0.5
+        # edge functions, the weights of corner 0 and 1 scaled by the area
+        w0 = (x[t, 1] - cx) * (y[t, 2] - cy) - (x[t, 2] - cx) * (y[t, 1] - cy)
+        w1 = (x[t, 2] - cx) * (y[t, 0] - cy) - (x[t, 0] - cx) * (y[t, 2] - cy)
+        w2 = area[t] - w0 - w1
+        sign = numpy.sign(area[t])
+        inside = (w0 * sign >= 0) & (w1 * sign >= 0) & (w2 * sign >= 0)
+        t = t[inside]
+        w0 = w0[inside] / area[t]
+        w1 = w1[inside] / area[t]
+        w2 = 1 - w0 - w1
+        index = py[inside] * width + px[inside]
+        # relative to corner 0 so flat triangles interpolate exactly
+        depth = z[t, 0] + w1 * (z[t, 1] - z[t, 0]) + w2 * (z[t, 2] - z[t, 0])
+        front = depth >= zbuffer.flat[index]
+        order = numpy.lexsort((t[front], depth[front]))
+        index = index[front][order]
+        zbuffer.flat[index] = depth[front][order]
+        t = t[front][order]
+        c = shade[t, 0] + w1[front][order] * (shade[t, 1] - shade[t, 0]) + w2[front][order] * (shade[t, 2] - shade[t, 0])
+        c = (numpy.clip(c, 0, 1) * 255 + 0.5).astype(numpy.uint8)
+        pixels[index, 0] = c
+        pixels[index, 1] = c
+        pixels[index, 2] = c
+        pixels[index, 3] = 255
+
+def raster_lines(image, x, y, color, line_width):
+    # x and y are (N,2) pixel space end points, lines are drawn by stepping
+    # a line_width square along them
+    height, width = image.shape[:2]
+    dx = x[:, 1] - x[:, 0]
+    dy = y[:, 1] - y[:, 0]
+    count = numpy.ceil(numpy.maximum(abs(dx), abs(dy))).astype(numpy.int64) + 1
+    pixels = image.reshape(-1, 4)
+    for a, b in batches(count * line_width * line_width):
+        n = count[a:b]
+        l = numpy.repeat(numpy.arange(a, b), n)
+        step = (numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)) / numpy.maximum(count[l] - 1, 1).astype(numpy.float64)
+        px = numpy.floor(x[l, 0] + dx[l] * step).astype(numpy.int64)
+        py = numpy.floor(y[l, 0] + dy[l] * step).astype(numpy.int64)
+        for ox in range(-(line_width / 2), line_width - line_width / 2):
+            for oy in range(-(line_width / 2), line_width - line_width / 2):
+                sx = px + ox
+                sy = py + oy
+                keep = (sx >= 0) & (sx < width) & (sy >= 0) & (sy < height)
+                pixels[sy[keep] * width + sx[keep]] = color
+
+def overview(f, model=0):
+    # windings of the faces drawn for a model and their extent
+    faces = f.model_faces(model)
+    offsets, polygons = f.face_windings(faces)
+    points = f.lump_array('vertices')[polygons]
+
+    m_max = vec3(-9999, -9999, -9999)
+    m_min = vec3(9999, 9999, 9999)
+    if len(points):
+        m_max = vec3(points.max(axis=0).tolist())
+        m_min = vec3(points.min(axis=0).tolist())
+    return offsets, points, m_min, m_max
+
+gl_window = None
+
+def gl_upload(target, data):
+    # copy an array into a new static buffer object, vertex data as
+    # float32 and indices as uint32
+    if data.dtype.kind == 'f':
+        data = numpy.ascontiguousarray(data, numpy.float32)
+    else:
+        data = numpy.ascontiguousarray(data, numpy.uint32)
+    buf = glGenBuffers(1)
+    glBindBuffer(target, buf)
+    glBufferData(target, data.nbytes, data, GL_STATIC_DRAW)
+    return buf
+
+def render_gl(f, offsets, points, m_min, m_max):
+    os = m_max - m_min
+
+    width = os[0]
+    height = os[1]
+    scale = os[2]
+
+    if width > height:
+        size = width
+    else:
+        size = height
+
+    size = int(size)
+
+    global gl_window
+    if gl_window is None:
+        # one window per process, batch workers reuse it for every map
+        glutInit(("none"))
+        gl_window = glutCreateWindow("test")
+
+    # create FBO and bind it (that is, use offscreen render target)
+    fb = glGenFramebuffersEXT(1)
+    glBindFramebufferEXT(GL_FRAMEBUFFER_EXT,fb)
+
+    # create texture
+    tex = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_RECTANGLE_ARB,tex)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    glViewport(0,0,int(width),int(height))
+    glOrtho(0,int(width), int(height), 0, -99999, 99999)
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+
+    # set texture parameters
+    glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_WRAP_S, GL_CLAMP)
+    glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_WRAP_T, GL_CLAMP)
+
+    # define texture with floating point format
+    glTexImage2D(GL_TEXTURE_RECTANGLE_ARB,0,GL_RGBA, size,size,0,GL_RGBA,GL_UNSIGNED_BYTE,None)
+
+    # attach texture
+    glFramebufferTexture2DEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_TEXTURE_RECTANGLE_ARB,tex,0)
+    # and read back
+
+    glClearColor(0, 0, 0, 0)
+    glClearDepth(0)
+    glClear(GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
+    glEnable(GL_BLEND)
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_ALPHA_TEST)
+    glDepthFunc(GL_GEQUAL)
+    glCullFace(GL_FRONT)
+
+    glDrawBuffer(GL_COLOR_ATTACHMENT0_EXT)
+    glReadBuffer(GL_COLOR_ATTACHMENT0_EXT)
+
+    glBindTexture(GL_TEXTURE_RECTANGLE_ARB, 0)
+    glDisable(GL_TEXTURE_2D)
+
+    glColor4f(1, 1, 1, 1)
+
+    glTranslatef(-m_min[0], -m_min[1], 0)
+
+    # every edge and face goes to the card once and is drawn with a
+    # single call per pass
+    buffers = []
+    glEnableClientState(GL_VERTEX_ARRAY)
+
+    vertices = f.lump_array('vertices')
+    lines = vertices[f.lump_array('edges')[:-1]].reshape(-1, 3)
+    buffers.append(gl_upload(GL_ARRAY_BUFFER, lines))
+    glVertexPointer(3, GL_FLOAT, 0, None)
+    glLineWidth(4)
+    glColor4f(0, 0, 0, 1)
+    glDrawArrays(GL_LINES, 0, len(lines))
+
+    """
+    glPointSize(5)
+    glBegin(GL_POINTS)
+    for i in range(f.header['vertices']['num']):
+        v1 = vec3(f.vertices[i])
+        a1 = (v1[2] + f.minimum[2])/scale
+        dv = v1 + os
+        print a1
+        print i
+        print dv
+        glColor4f(a1, a1, a1, 1)
+        glVertex4f(dv[0], dv[1], dv[2], a1)
     glEnd()
-
-"""
-glPointSize(5)
-glBegin(GL_POINTS)
-for i in range(f.header['vertices']['num']):
-    v1 = vec3(f.vertices[i])
-    a1 = (v1[2] + f.minimum[2])/scale
-    dv = v1 + os
-    print a1
-    print i
-    print dv
-    glColor4f(a1, a1, a1, 1)
-    glVertex4f(dv[0], dv[1], dv[2], a1)
-glEnd()
-"""
-
-"""
-min_l = 0
-max_l = f.header['leaves']['num']
-for i in range(0, max_l-1):
-    min_f = f.leaves[i]['face_id']
-    max_f = f.leaves[i]['face_num'] + min_f
-    for l in range(min_f, max_f):
-        print str(l) + ": " + str(f.faces[l])
-"""
-
-
-min_f = f.models[0]['face_id']
-max_f = f.models[0]['face_num'] + min_f
-
-print "size: " + str(size)
-
-m_min = vec3(0, 0, 0)
-m_max = vec3(0, 0, 0)
-
-#if 0 :
-for i in range(min_f, max_f):
-    n = vec3(f.planes[f.faces[i]['plane_id']]['normal'])
-    if (check_normal(n) and f.faces[i]['side'] == 0):
-        y = f.faces[i]['ledge_id']
-        glBegin(GL_POLYGON)
-        for x in range(f.faces[i]['ledge_num'] - 1):
-            ledge = abs(f.ledges[x + y][0])
-            if (f.ledges[x+y][0] > 0):
-                v1 = vec3(f.vertices[f.edges[ledge][0]])
-                v2 = vec3(f.vertices[f.edges[ledge][1]])
+    """
+
+    """
+    min_l = 0
+    max_l = f.header['leaves']['num']
+    for i in range(0, max_l-1):
+        min_f = f.leaves[i]['face_id']
+        max_f = f.leaves[i]['face_num'] + min_f
+        for l in range(min_f, max_f):
+            print str(l) + ": " + str(f.faces[l])
+    """
+
+    print "size: " + str(size)
+
+    m_min = vec3(0, 0, 0)
+    m_max = vec3(0, 0, 0)
+    if len(points):
+        m_max = vec3(numpy.maximum(points.max(axis=0), 0).tolist())
+        m_min = vec3(numpy.minimum(points.min(axis=0), 0).tolist())
+
+    colors = numpy.ones((len(points), 4), numpy.float32)
+    colors[:, :3] = (points[:, 2] / scale)[:, numpy.newaxis]
+    buffers.append(gl_upload(GL_ARRAY_BUFFER, points))
+    glVertexPointer(3, GL_FLOAT, 0, None)
+    buffers.append(gl_upload(GL_ARRAY_BUFFER, colors))
+    glColorPointer(4, GL_FLOAT, 0, None)
+    glEnableClientState(GL_COLOR_ARRAY)
+    triangles = fan_triangles(offsets)
+    buffers.append(gl_upload(GL_ELEMENT_ARRAY_BUFFER, triangles))
+    glDrawElements(GL_TRIANGLES, triangles.size, GL_UNSIGNED_INT, None)
+
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    glFlush();
+    glDeleteBuffers(len(buffers), buffers)
+
+    print m_max
+    print m_min
+
+    start = time.time()
+    data = glReadPixels(0, 0, width, height,GL_RGBA,GL_UNSIGNED_BYTE)
+    profile_stage('readback', start, bytes=len(data))
+    # the window outlives this map, free what was made for it
+    glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+    glDeleteFramebuffersEXT(1, [fb])
+    glDeleteTextures([tex])
+    image = Image.fromstring(mode="RGBA", size=(int(width), int(height)), data=data)
+    image.transpose(Image.FLIP_LEFT_RIGHT)
+    image.transpose(Image.FLIP_TOP_BOTTOM)
+    return image
+
+def soft_geometry(f, offsets, points):
+    # world space lines (E,2,3) and triangles (T,3,3) drawn by the
+    # software renderer
+    vertices = f.lump_array('vertices')
+    lines = vertices[f.lump_array('edges')[:-1]]
+    triangles = points[fan_triangles(offsets)]
+    return lines, triangles
+
+def narrow_geometry(lines, triangles, left, upper, width, height, margin):
+    # the lines and triangles reaching into the width x height world units
+    # right of and below left, upper, lines within margin around it
+    keep = ((lines[:, :, 0].max(axis=1) >= left - margin) & (lines[:, :, 0].min(axis=1) <= left + width + margin) &
+            (lines[:, :, 1].max(axis=1) >= upper - height - margin) & (lines[:, :, 1].min(axis=1) <= upper + margin))
+    lines = lines[keep]
+    keep = ((triangles[:, :, 0].max(axis=1) >= left) & (triangles[:, :, 0].min(axis=1) <= left + width) &
+            (triangles[:, :, 1].max(axis=1) >= upper - height) & (triangles[:, :, 1].min(axis=1) <= upper))
+    return lines, triangles[keep]
+
+def render_view(lines, triangles, left, top, width, height, scale, zscale):
+    # RGBA pixels of the width x height area whose top left corner is at
+    # left, top in world units, with scale pixels per unit. Rows run from
+    # the top of the map down like the rows glReadPixels returns.
+    image = numpy.zeros((height, width, 4), numpy.uint8)
+    zbuffer = numpy.empty((height, width), numpy.float64)
+    zbuffer.fill(-numpy.inf)
+
+    x = (lines[:, :, 0] - left) * scale
+    y = (top - lines[:, :, 1]) * scale
+    keep = (x.max(axis=1) >= -4) & (x.min(axis=1) <= width + 4) & (y.max(axis=1) >= -4) & (y.min(axis=1) <= height + 4)
+    raster_lines(image, x[keep], y[keep], (0, 0, 0, 255), 4)
+
+    x = (triangles[:, :, 0] - left) * scale
+    y = (top - triangles[:, :, 1]) * scale
+    keep = (x.max(axis=1) >= 0) & (x.min(axis=1) <= width) & (y.max(axis=1) >= 0) & (y.min(axis=1) <= height)
+    z = triangles[keep, :, 2].astype(numpy.float64)
+    raster_triangles(image, zbuffer, x[keep], y[keep], z, z / zscale)
+    return image
+
+def render_region(f, model, mins, maxs, scale):
+    # pixels of the rectangle mins to maxs (x, y in world units) of a model
+    # seen from above, like render_soft draws it. Only faces found in the
+    # rectangle by the face hierarchy are drawn, the shading follows the
+    # height of the whole model.
+    drawn = f.model_faces(model)
+    width = int((maxs[0] - mins[0]) * scale)
+    height = int((maxs[1] - mins[1]) * scale)
+    offsets, found = f.faces_in_region(mins, maxs)
+
+    # edges of every face around, triangles of the faces of the model
+    vertices = f.lump_array('vertices')
+    offsets, ids = f.face_windings(found)
+    count = numpy.diff(offsets)
+    local = numpy.arange(len(ids)) - numpy.repeat(offsets[:-1], count)
+    following = numpy.repeat(offsets[:-1], count) + (local + 1) % numpy.repeat(count, count)
+    lines = vertices[numpy.column_stack((ids, ids[following]))]
+    offsets, ids = f.face_windings(numpy.intersect1d(found, drawn))
+    triangles = vertices[ids][fan_triangles(offsets)]
+
+    zscale = 1
+    if len(drawn):
+        zscale = f.face_maxs[drawn, 2].max() - f.face_mins[drawn, 2].min()
+    return render_view(lines, triangles, mins[0], mins[1] + height / float(scale),
+            width, height, scale, zscale)
+
+def render_soft(f, offsets, points, m_min, m_max):
+    # the same picture as render_gl on the cpu: black edges first, then the
+    # faces shaded by height. The gl framebuffer has no depth attachment so
+    # faces simply overdraw each other there, here the top most face wins.
+    extent = m_max - m_min
+    width = int(extent[0])
+    height = int(extent[1])
+
+    lines, triangles = soft_geometry(f, offsets, points)
+    image = render_view(lines, triangles, m_min[0], m_min[1] + height, width, height, 1, extent[2])
+    return Image.fromstring(mode="RGBA", size=(width, height), data=image.tostring())
+
+def render_tiled(f, offsets, points, m_min, m_max, outputfile, scale, tile):
+    # renders tile x tile pixel pieces in software and streams each row of
+    # tiles into the png, only one row of tiles is ever held in memory
+    extent = m_max - m_min
+    width = int(extent[0] * scale)
+    height = int(extent[1] * scale)
+    top = m_min[1] + height / float(scale)
+
+    lines, triangles = soft_geometry(f, offsets, points)
+    margin = 4 / float(scale)
+    png = PNG_Writer(outputfile, width, height)
+    for row in range(0, height, tile):
+        band = numpy.empty((min(tile, height - row), width, 4), numpy.uint8)
+        # the geometry of a row of tiles, then of each tile in it
+        upper = top - row / float(scale)
+        row_lines, row_triangles = narrow_geometry(lines, triangles, m_min[0], upper,
+                width / float(scale), len(band) / float(scale), margin)
+        for col in range(0, width, tile):
+            w = min(tile, width - col)
+            left = m_min[0] + col / float(scale)
+            tile_lines, tile_triangles = narrow_geometry(row_lines, row_triangles, left, upper,
+                    w / float(scale), len(band) / float(scale), margin)
+            band[:, col:col + w] = render_view(tile_lines, tile_triangles,
+                    left, upper, w, len(band), scale, extent[2])
+        png.write(band)
+    png.close()
+
+def downsample(pixels):
+    # halves an image by averaging 2 x 2 blocks
+    height, width = pixels.shape[:2]
+    blocks = pixels.reshape(height / 2, 2, width / 2, 2, -1).astype(numpy.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) / 4).astype(numpy.uint8)
+
+def render_pyramid(f, offsets, points, m_min, m_max, outdir, scale, tile):
+    # zoomable pyramid of tile x tile pngs in outdir/z/x/y.png, rows
+    # counted from the top of the map. The deepest level is rendered at
+    # scale pixels per unit, every level above is made by downsampling the
+    # four tiles below it. manifest.json keeps the content hash of every
+    # tile, on the next run only tiles whose hash changed are made and
+    # written again. Tiles without any geometry are left out.
+    extent = m_max - m_min
+    width = int(extent[0] * scale)
+    height = int(extent[1] * scale)
+    top = m_min[1] + height / float(scale)
+    zoom = 0
+    while tile << zoom < max(width, height):
+        zoom += 1
+
+    manifestfile = os.path.join(outdir, "manifest.json")
+    try:
+        old = json.load(open(manifestfile))['tiles']
+    except (IOError, ValueError, KeyError):
+        old = {}
+    # a leaf hash covers its geometry and everything placing it
+    params = repr((tile, scale, zoom, list(m_min), list(m_max)))
+    tiles = {}
+    stats = {'rendered': 0, 'written': 0, 'kept': 0}
+
+    def tile_file(name):
+        return os.path.join(outdir, name + ".png")
+
+    def build(z, x, y, lines, triangles):
+        # content hash of a tile (None if empty) and its pixels if they
+        # had to be made, the geometry is narrowed down on the way down
+        size = (tile << (zoom - z)) / float(scale)
+        left = m_min[0] + x * size
+        upper = top - y * size
+        lines, triangles = narrow_geometry(lines, triangles, left, upper, size, size, 4 / float(scale))
+        if len(lines) == 0 and len(triangles) == 0:
+            return None, None
+
+        name = "%i/%i/%i" % (z, x, y)
+        h = hashlib.sha1(params + name)
+        quads = ((0, 0), (1, 0), (0, 1), (1, 1))
+        if z == zoom:
+            h.update(lines.tostring())
+            h.update(triangles.tostring())
+        else:
+            children = [build(z + 1, 2 * x + dx, 2 * y + dy, lines, triangles) for dx, dy in quads]
+            h.update(repr([key for key, pixels in children]))
+        key = h.hexdigest()
+        tiles[name] = key
+        if old.get(name) == key and os.path.isfile(tile_file(name)):
+            stats['kept'] += 1
+            return key, None
+
+        if z == zoom:
+            pixels = render_view(lines, triangles, left, upper, tile, tile, scale, extent[2])
+            stats['rendered'] += 1
+        else:
+            quad = numpy.zeros((2 * tile, 2 * tile, 4), numpy.uint8)
+            for (dx, dy), (child, pixels) in zip(quads, children):
+                if child is None:
+                    continue
+                if pixels is None:
+                    pixels = read_png(tile_file("%i/%i/%i" % (z + 1, 2 * x + dx, 2 * y + dy)))
+                quad[dy * tile:(dy + 1) * tile, dx * tile:(dx + 1) * tile] = pixels
+            pixels = downsample(quad)
+
+        if not os.path.isdir(os.path.dirname(tile_file(name))):
+            os.makedirs(os.path.dirname(tile_file(name)))
+        png = PNG_Writer(tile_file(name), tile, tile)
+        png.write(pixels)
+        png.close()
+        stats['written'] += 1
+        return key, pixels
+
+    lines, triangles = soft_geometry(f, offsets, points)
+    build(0, 0, 0, lines, triangles)
+
+    # tiles that became empty
+    for name in old:
+        if name not in tiles and os.path.isfile(tile_file(name)):
+            os.remove(tile_file(name))
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest = {'tile': tile, 'scale': scale, 'zoom': zoom, 'width': width,
+            'height': height, 'minimum': list(m_min), 'maximum': list(m_max),
+            'tiles': tiles}
+    temp = "%s.%i" % (manifestfile, os.getpid())
+    out = open(temp, 'w')
+    json.dump(manifest, out, indent=1, sort_keys=True)
+    out.close()
+    os.rename(temp, manifestfile)
+    return stats
+
+class PNG_Writer:
+    # writes an RGBA png a few rows at a time, only the compressor state
+    # is kept between calls
+    def __init__(self, filename, width, height):
+        self.width = width
+        # a file name, or an open file that is left open
+        self.owned = isinstance(filename, basestring)
+        if self.owned:
+            self.file = open(filename, 'wb')
+        else:
+            self.file = filename
+        self.file.write('\x89PNG\r\n\x1a\n')
+        self.chunk('IHDR', struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        self.compressor = zlib.compressobj(6)
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def write(self, rows):
+        # (n, width, 4) uint8 rows, each gets the "none" filter byte
+        data = numpy.zeros((len(rows), self.width * 4 + 1), numpy.uint8)
+        data[:, 1:] = rows.reshape(len(rows), -1)
+        compressed = self.compressor.compress(data.tostring())
+        if compressed:
+            self.chunk('IDAT', compressed)
+
+    def close(self):
+        self.chunk('IDAT', self.compressor.flush())
+        self.chunk('IEND', '')
+        if self.owned:
+            self.file.close()
+
+def read_png(filename):
+    # reads back what PNG_Writer wrote, RGBA rows with the "none" filter
+    data = open(filename, 'rb').read()
+    offset = 8
+    idat = []
+    while offset < len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        if kind == 'IHDR':
+            width, height = struct.unpack_from(">II", data, offset + 8)
+        elif kind == 'IDAT':
+            idat.append(data[offset + 8:offset + 8 + length])
+        offset += length + 12
+    rows = numpy.fromstring(zlib.decompress(''.join(idat)), numpy.uint8)
+    return rows.reshape(height, width * 4 + 1)[:, 1:].reshape(height, width, 4)
+
+
+def load_palette(filename):
+    # 256 rgb triplets, palette.lmp from the game data
+    palette = numpy.fromfile(filename, numpy.uint8, 768)
+    if len(palette) != 768:
+        raise IOError("\"%s\" is too short for a palette" % filename)
+    return palette.reshape(256, 3)
+
+def texture_name(name):
+    # file name of a texture, * and / can not be in it
+    return name.replace('*', '#').replace('/', '_')
+
+texture_palette = None
+texture_map = (None, None)
+
+def texture_worker_init(palette):
+    global texture_palette
+    texture_palette = palette
+
+def export_texture(job):
+    # runs in the pool, writes every mip level of one texture as png
+    global texture_map
+    filename, index, outdir = job
+    try:
+        if texture_map[0] != filename:
+            texture_map = (filename, open_map(filename, True, True))
+        f = texture_map[1]
+        name = texture_name(f.miptex[index]['name'])
+        written = []
+        for level, pixels in enumerate(f.texture_levels(index)):
+            if level == 0:
+                outputfile = os.path.join(outdir, name + ".png")
             else:
-                v1 = vec3(f.vertices[f.edges[ledge][1]])
-                v2 = vec3(f.vertices[f.edges[ledge][0]])
-
-            for t in range(0, 3):
-                if (v1[t] > m_max[t]):
-                    m_max[t] = v1[t]
-                if (v1[t] < m_min[t]):
-                    m_min[t] = v1[t]
-                if (v2[t] > m_max[t]):
-                    m_max[t] = v2[t]
-                if (v2[t] < m_min[t]):
-                    m_min[t] = v2[t]
-            a1 = (v1[2])/scale
-            a2 = (v2[2])/scale
-            glColor4f(a1, a1, a1, 1)
-            glVertex3f(v1[0], v1[1], v1[2])
-            glColor4f(a2, a2, a2, 1)
-            glVertex3f(v2[0], v2[1], v2[2])
-        glEnd()
-
-glFlush();
-
-print m_max
-print m_min
-
-data = glReadPixels(0, 0, width, height,GL_RGBA,GL_UNSIGNED_BYTE)
-image = Image.fromstring(mode="RGBA", size=(int(width), int(height)), data=data)
-image.transpose(Image.FLIP_LEFT_RIGHT)
-image.transpose(Image.FLIP_TOP_BOTTOM)
-outputfile = ifile[:ifile.find(".")]+".png"
-print outputfile 
-image.save(outputfile, "PNG")
-    
-
-print "test"
-
-
-sys.exit()
-
-
-
-for i in range(f.header['faces']['num'] - 1):
-    print "%5i:" % i
-    print f.planes[f.faces[i]['plane_id']]['normal']
-    y = f.faces[i]['ledge_id']
-    print "ledge id: " + str(y)
-    print "ledges: " + str(f.ledges[y])
-    print "ledges: " + str(abs(f.ledges[y][0]))
-    print f.header['edges']['num']
-    for x in range(f.faces[i]['ledge_num'] - 1):
-        ledge = abs(f.ledges[y][0]) + x
-        if (f.ledges[y][0] > 0):
-            v1 = f.vertices[f.edges[ledge][0]]
-            v2 = f.vertices[f.edges[ledge][1]]
+                outputfile = os.path.join(outdir, "%s_mip%i.png" % (name, level))
+            rgb = texture_palette[pixels]
+            image = Image.fromstring(mode="RGB", size=(pixels.shape[1], pixels.shape[0]), data=rgb.tostring())
+            image.save(outputfile, "PNG")
+            written.append(outputfile)
+        return filename, index, written, None
+    except Exception, err:
+        return filename, index, [], "%s: %s" % (err.__class__.__name__, err)
+
+def export_textures(maps, palettefile, jobs, outdir="textures"):
+    start = time.time()
+    try:
+        palette = load_palette(palettefile)
+    except IOError, err:
+        print "failed palette %s: %s" % (palettefile, err)
+        return 1
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    failed = 0
+    tasks = []
+    # maps of a pack share most textures, each name is written once from
+    # the first map holding it
+    names = set()
+    for ifile in maps:
+        try:
+            f = open_map(ifile, True, True)
+            if f.invalid == True:
+                raise IOError(f.error)
+            for index, texture in enumerate(f.miptex):
+                if texture is not None and texture_name(texture['name']) not in names:
+                    names.add(texture_name(texture['name']))
+                    tasks.append((ifile, index, outdir))
+        except Exception, err:
+            failed += 1
+            print "failed %s: %s: %s" % (ifile, err.__class__.__name__, err)
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, texture_worker_init, (palette,))
+        results = pool.imap_unordered(export_texture, tasks, 16)
+    else:
+        pool = None
+        texture_worker_init(palette)
+        results = itertools.imap(export_texture, tasks)
+
+    images = 0
+    for ifile, index, written, error in results:
+        images += len(written)
+        if error is not None:
+            failed += 1
+            print "failed %s texture %i: %s" % (ifile, index, error)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print "%i textures, %i images, %i failed, %.3fs" % (len(tasks), images, failed, elapsed)
+    return failed
+
+def model_mesh(f, model=0, group=False):
+    # one indexed triangle list of every face of a model. Corners with the
+    # same vertex, texture coordinates and face plane are stored once.
+    # With group the triangles are sorted by texture. Returns positions,
+    # normals, uvs, triangles and the (name, first triangle, count) groups.
+    m = f.lump_array('models')[model]
+    faces = numpy.arange(m['face_id'], m['face_id'] + m['face_num'])
+    first = f.polygon_offsets[m['face_id']]
+    offsets = f.polygon_offsets[m['face_id']:m['face_id'] + m['face_num'] + 1] - first
+    ids = f.polygon_vertices[first:offsets[-1] + first]
+    uvs = f.polygon_uvs[first:offsets[-1] + first].astype(numpy.float32)
+    data = f.lump_array('faces')[faces]
+    side = numpy.repeat(data['plane_id'].astype(numpy.int32) * 2 + (data['side'] != 0), numpy.diff(offsets))
+
+    # merge equal corners
+    order = numpy.lexsort((uvs[:, 1], uvs[:, 0], side, ids))
+    new = numpy.ones(len(order), bool)
+    new[1:] = (numpy.diff(ids[order]) != 0) | (numpy.diff(side[order]) != 0) | \
+            (numpy.diff(uvs[order], axis=0) != 0).any(axis=1)
+    index = numpy.empty(len(order), numpy.uint32)
+    index[order] = numpy.cumsum(new) - 1
+    corners = order[new]
+
+    normals = f.lump_array('planes')['normal'][side[corners] / 2]
+    normals[side[corners] % 2 == 1] *= -1
+    positions = f.lump_array('vertices')[ids[corners]]
+
+    # windings run clockwise seen from the front, the triangles are
+    # turned around to the usual counter clockwise order
+    triangles = index[fan_triangles(offsets)[:, ::-1]]
+    groups = [(None, 0, len(triangles))]
+    if group:
+        miptex = f.lump_array('texinfo')['miptex'][data['texinfo_id']]
+        miptex = numpy.repeat(miptex, numpy.maximum(numpy.diff(offsets) - 2, 0))
+        order = numpy.argsort(miptex, kind='mergesort')
+        triangles = triangles[order]
+        values, starts, counts = numpy.unique(miptex[order], return_index=True, return_counts=True)
+        groups = []
+        for value, start, count in zip(values.tolist(), starts.tolist(), counts.tolist()):
+            name = "miptex%i" % value
+            if value < len(f.miptex) and f.miptex[value] is not None:
+                name = f.miptex[value]['name']
+            groups.append((name, start, count))
+    return positions, normals, uvs[corners], triangles, groups
+
+def float_text(values):
+    # "%.6g" of every value as a tuple for one % over a whole block of
+    # lines. Maps reuse few distinct coordinates, only those are formatted.
+    values, inverse = numpy.unique(values, return_inverse=True)
+    text = numpy.array(["%.6g" % v for v in values.tolist()], object)
+    return tuple(text[inverse].tolist())
+
+def write_obj(filename, positions, normals, uvs, triangles, groups):
+    # obj has no up axis, the map coordinates are kept, texture rows run
+    # upwards there
+    out = open(filename, "wb")
+    out.write(("v %s %s %s\n" * len(positions)) % float_text(positions.ravel()))
+    flipped = uvs.copy()
+    flipped[:, 1] = 1 - flipped[:, 1]
+    out.write(("vt %s %s\n" * len(uvs)) % float_text(flipped.ravel()))
+    out.write(("vn %s %s %s\n" * len(normals)) % float_text(normals.ravel()))
+    # v/vt/vn share the index, %s formats python ints faster than %i
+    corners = numpy.repeat(triangles.astype(numpy.int64) + 1, 3, axis=1)
+    for name, first, count in groups:
+        if name is not None:
+            out.write("g %s\nusemtl %s\n" % (name, name))
+        out.write(("f %s/%s/%s %s/%s/%s %s/%s/%s\n" * count) % tuple(corners[first:first + count].ravel().tolist()))
+    out.close()
+
+def write_glb(filename, positions, normals, uvs, triangles, groups):
+    # binary gltf, one primitive per group sharing the vertex arrays. gltf
+    # is y up, map z becomes y.
+    axes = numpy.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]], numpy.float32)
+    positions = numpy.dot(positions, axes).astype('<f4')
+    normals = numpy.dot(normals, axes).astype('<f4')
+    arrays = [positions, normals, uvs.astype('<f4'), triangles.astype('<u4')]
+    views = []
+    offset = 0
+    for data, target in zip(arrays, (34962, 34962, 34962, 34963)):
+        views.append({'buffer': 0, 'byteOffset': offset, 'byteLength': data.nbytes, 'target': target})
+        offset += data.nbytes
+    accessors = [
+        {'bufferView': 0, 'componentType': 5126, 'count': len(positions), 'type': 'VEC3'},
+        {'bufferView': 1, 'componentType': 5126, 'count': len(normals), 'type': 'VEC3'},
+        {'bufferView': 2, 'componentType': 5126, 'count': len(uvs), 'type': 'VEC2'},
+    ]
+    if len(positions):
+        accessors[0]['min'] = positions.min(axis=0).tolist()
+        accessors[0]['max'] = positions.max(axis=0).tolist()
+    primitives = []
+    materials = []
+    for name, first, count in groups:
+        if not count:
+            continue
+        primitive = {'attributes': {'POSITION': 0, 'NORMAL': 1, 'TEXCOORD_0': 2},
+                'indices': len(accessors), 'mode': 4}
+        accessors.append({'bufferView': 3, 'byteOffset': first * 12,
+                'componentType': 5125, 'count': count * 3, 'type': 'SCALAR'})
+        if name is not None:
+            primitive['material'] = len(materials)
+            materials.append({'name': name})
+        primitives.append(primitive)
+    document = {'asset': {'version': '2.0', 'generator': 'pybsp'},
+            'buffers': [{'byteLength': offset}], 'bufferViews': views,
+            'accessors': accessors, 'scene': 0, 'scenes': [{'nodes': []}]}
+    if primitives:
+        document['meshes'] = [{'primitives': primitives}]
+        document['nodes'] = [{'mesh': 0}]
+        document['scenes'][0]['nodes'] = [0]
+    if materials:
+        document['materials'] = materials
+
+    text = json.dumps(document, separators=(',', ':'))
+    text += " " * (-len(text) % 4)
+    out = open(filename, "wb")
+    out.write(struct.pack("<4sII", "glTF", 2, 12 + 8 + len(text) + 8 + offset))
+    out.write(struct.pack("<I4s", len(text), "JSON") + text)
+    out.write(struct.pack("<I4s", offset, "BIN\0"))
+    for data in arrays:
+        out.write(data.tostring())
+    out.close()
+
+mesh_writers = {'.obj': write_obj, '.glb': write_glb}
+
+def export_mesh(f, filename, model=0, group=False):
+    # writes the faces of a model as obj or glb by the file extension,
+    # returns the number of triangles
+    mesh = model_mesh(f, model, group)
+    mesh_writers[os.path.splitext(filename)[1].lower()](filename, *mesh)
+    return len(mesh[3])
+
+def rewrite_name(name):
+    # the member path for maps in archives, the path as given otherwise
+    # so maps of the same name in different directories stay apart
+    pakfile, member = split_member(name)
+    if pakfile is None:
+        member = os.path.relpath(name)
+        if member.startswith(os.pardir):
+            member = os.path.abspath(name).lstrip(os.sep)
+    return os.path.join(rewrite_dir, member)
+
+def rewrite_collisions(maps):
+    # maps written to the same file, members of different archives can be
+    names = {}
+    collisions = []
+    for ifile in maps:
+        outputfile = rewrite_name(ifile)
+        if outputfile in names:
+            collisions.append((names[outputfile], ifile, outputfile))
+        names[outputfile] = ifile
+    return collisions
+
+def rewrite_map(f, outputfile):
+    if not os.path.isdir(os.path.dirname(outputfile) or '.'):
+        try:
+            os.makedirs(os.path.dirname(outputfile))
+        except OSError:
+            # another worker made it first
+            pass
+    writer = BSP_Writer(f)
+    if compact_maps:
+        writer.compact()
+    for name in strip_lumps:
+        writer.remove(name)
+    return writer.write(outputfile)
+
+def render_map(ifile, verbose=False):
+    start = time.time()
+    # every output reads the lumps as arrays, decoding them into rows
+    # first would only cost time and memory
+    f = open_map(ifile, use_mmap, True, cache_dir=cache_dir)
+    profile_stage('open', start, bytes=f.bytes_read)
+
+    if f.invalid == True:
+        raise IOError(f.error)
+
+    if verbose:
+        print "Filesize: %i" % f.filesize
+        print f.header['models']['num']
+
+        model = f.lump_array('models')[0]
+        bounding_box = tuple(vec3(v) for v in model['bounding_box'].tolist())
+        origin = vec3(model['origin'].tolist())
+        print bounding_box
+        print origin
+
+        rs = bounding_box[1] - bounding_box[0]
+        rs = rs + origin
+        b = bounding_box[0]
+
+        print "rs: " + str(rs)
+        print vec3(-b[0], -b[1], -b[2])
+
+    if rewrite_dir is not None:
+        start = time.time()
+        outputfile = rewrite_name(ifile)
+        size = rewrite_map(f, outputfile)
+        profile_stage('rewrite', start, bytes=size)
+        return outputfile
+
+    if mesh_format is not None:
+        start = time.time()
+        outputfile = output_name(ifile, "." + mesh_format)
+        triangles = export_mesh(f, outputfile, 0, group_textures)
+        profile_stage('export', start, bytes=os.path.getsize(outputfile), records=triangles)
+        return outputfile
+
+    start = time.time()
+    offsets, points, m_min, m_max = overview(f)
+    profile_stage('overview', start, records=len(offsets) - 1)
+
+    if verbose:
+        print "max: " + str(m_max)
+        print "min: " + str(m_min)
+        print "width: " + str(m_max[0] - m_min[0])
+        print "height: " + str(m_max[1] - m_min[1])
+
+    start = time.time()
+    if pyramid:
+        outdir = output_name(ifile, "")
+        stats = render_pyramid(f, offsets, points, m_min, m_max, outdir, resolution, tile_size or 256)
+        profile_stage('render_pyramid', start, **stats)
+        return outdir
+
+    outputfile = output_name(ifile, ".png")
+    if tile_size:
+        # rendering and encoding are interleaved here
+        render_tiled(f, offsets, points, m_min, m_max, outputfile, resolution, tile_size)
+        profile_stage('render_tiled', start, bytes=os.path.getsize(outputfile))
+        return outputfile
+
+    if software:
+        image = render_soft(f, offsets, points, m_min, m_max)
+    else:
+        image = render_gl(f, offsets, points, m_min, m_max)
+    profile_stage('render', start, pixels=image.size[0] * image.size[1])
+
+    start = time.time()
+    image.save(outputfile, "PNG")
+    profile_stage('encode', start, bytes=os.path.getsize(outputfile))
+    return outputfile
+
+def write_profile(reports):
+    text = json.dumps({'maps': reports}, indent=1, sort_keys=True)
+    if profile_file == "-":
+        print text
+        return
+    out = open(profile_file, 'w')
+    out.write(text + "\n")
+    out.close()
+
+def pak_maps(pakfile, pattern=None):
+    # maps in an archive in the order they are stored, a batch reads the
+    # archive front to back
+    return ["%s:%s" % (pakfile, name) for name in open_pak(pakfile).find(pattern)
+            if name.lower().endswith(".bsp")]
+
+def find_maps(args):
+    # files, directories (searched recursively), glob patterns and pak
+    # archives, an archive may be followed by a regexp selecting members
+    maps = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if os.path.isdir(arg):
+            for path, dirs, files in os.walk(arg):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(".bsp"):
+                        maps.append(os.path.join(path, name))
+                    elif name.lower().endswith(".pak"):
+                        maps.extend(pak_maps(os.path.join(path, name)))
+        elif glob.has_magic(arg) and not os.path.exists(arg):
+            for name in sorted(glob.glob(arg)):
+                if name.lower().endswith(".pak"):
+                    maps.extend(pak_maps(name))
+                else:
+                    maps.append(name)
+        elif arg.lower().endswith(".pak") and os.path.isfile(arg):
+            pattern = None
+            if args and not os.path.exists(args[0]):
+                pattern = args.pop(0)
+            maps.extend(pak_maps(arg, pattern))
         else:
-            v1 = f.vertices[f.edges[ledge][1]]
-            v2 = f.vertices[f.edges[ledge][0]]
-        print v1
-        print v2
-        if (x == 0):
-            ctx.move_to(os[0] + v1[0], os[1] + v1[1])
+            maps.append(arg)
+    return maps
+
+def render_job(ifile):
+    # runs in the pool, a broken map is reported instead of raised
+    global profile
+    start = time.time()
+    if profile_file is not None:
+        profile = Profile(ifile)
+    outputfile = None
+    error = None
+    try:
+        outputfile = render_map(ifile)
+    except Exception, err:
+        error = "%s: %s" % (err.__class__.__name__, err)
+    report = None
+    if profile is not None:
+        report = profile.finish()
+        profile = None
+    return ifile, time.time() - start, outputfile, error, report
+
+def render_batch(maps, jobs):
+    start = time.time()
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(render_job, maps)
+    else:
+        pool = None
+        results = itertools.imap(render_job, maps)
+
+    failed = 0
+    reports = []
+    for ifile, seconds, outputfile, error, report in results:
+        if report is not None:
+            reports.append(report)
+        if error is None:
+            print "%8.3fs ok     %s -> %s" % (seconds, ifile, outputfile)
         else:
-            ctx.line_to(os[0] + v2[0], os[1] + v1[1])
-
-    ctx.close_path()
-    print "-----------------"
-    ctx.stroke()
-
-
-surface.write_to_png("test.png")
-sys.exit()
-
-
-surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
-ctx = cairo.Context (surface)
-
-a1 = 1
-a2 = 1
-
-os = []
-os.append(f.minimum[0] * -1)
-os.append(f.minimum[1] * -1)
-os.append(f.minimum[2] * -1)
-
-
-
-for i in range(f.header['edges']['num']):
-    v1 = f.vertices[f.edges[i][0]]
-    v2 = f.vertices[f.edges[i][1]]
-    ctx.move_to(os[0] + v1[0], os[1] + v1[1])
-    ctx.line_to(os[0] + v2[0], os[1] + v2[1])
-    a1 = (v1[2] + f.minimum[2])/scale
-    a2 = (v2[2] + f.minimum[2])/scale
-    linear = cairo.LinearGradient(os[0] + v1[0], os[1] + v1[1], os[0] + v2[0], os[1] + v2[1]);
-    linear.add_color_stop_rgb(0, a1, a1, a1)
-    linear.add_color_stop_rgb(1, a2, a2, a2)
-    ctx.close_path()
-    ctx.stroke()
-
-surface.write_to_png("test.png")
-
-
-sys.exit()
-
-print "opening %s" % ifile
-bsp_file = open(ifile, 'rb')
-print "filesize: %i" % len(bsp_file.read())
-bsp_file.seek(0,0)
-version = array.array('I', bsp_file.read(4))[0]
-print "header info:"
-print " version: %i" % version
-entities_offset = array.array('I', bsp_file.read(4))[0]
-entities_size = array.array('I', bsp_file.read(4))[0]
-print " entities:"
-print "  offset: %i" % entities_offset
-print "  Size: %i" % entities_size
-planes_offset = array.array('I', bsp_file.read(4))[0]
-planes_size = array.array('I', bsp_file.read(4))[0]
-print " planes:"
-print "  offset: %i" % planes_offset
-print "  Size: %i" % planes_size
-
-miptex_offset = array.array('I', bsp_file.read(4))[0]
-miptex_size = array.array('I', bsp_file.read(4))[0]
-print lump_planes
-lump_textures_fofs = array.array('I', bsp_file.read(4))[0]
-lump_textures_flen = array.array('I', bsp_file.read(4))[0]
-print "tfof  : %i" % lump_textures_fofs
-print "tflen : %i" % lump_textures_flen
-
-
-bsp_file.seek(lump_textures_fofs,0)
-gpos = bsp_file.tell()
-
-offset_base = bsp_file.tell()
-miptx_lump_c = array.array('I', bsp_file.read(4))[0]
-miptx_lump = {}
-
-print "mptl  : %i" % miptx_lump_c
-
-
-index_base = bsp_file.tell()
-
-textures = {}
-
-for i in range(0, miptx_lump_c):
-#for i in range(0, miptx_lump_c):
-	textures[i] = {} 
-	bsp_file.seek(index_base +  i * 4 ,0)
-	if i == 2:
-		bsp_file.seek(4,1)
-	offset = struct.unpack('I', bsp_file.read(4))[0]
-	print offset
-	#bsp_file.seek(orgpos + i * 4 * 4)
-	bsp_file.seek(offset_base + offset)
-	print "location %i" % bsp_file.tell()
-
-
-	textures[i]["name"] = ""
-	for x in range(0, 16):
-		s = bsp_file.read(1)
-		if s:
-			if ord(s) < 128 and ord(s) > 32 and s != '/':
-				if ord(s) != 42:
-					textures[i]["name"] += s;
-
-	textures[i]["name"] = textures[i]["name"][:-4]
-
-
-	print textures[i]["name"]
-
-	textures[i]["width"] = array.array('I', bsp_file.read(4))[0]
-	textures[i]["height"] = array.array('I', bsp_file.read(4))[0]
-	print "%i: %s %i %i" % (i,textures[i]["name"], textures[i]["width"], textures[i]["height"])
-	local_offset = bsp_file.tell()
-	ct_offset=  array.array('I', bsp_file.read(4))[0]
-	bsp_file.seek(local_offset + ct_offset, 0)
-	try:
-		os.mkdir("textures")
-	except OSError:
-		print "directory already existed"
-	name = "textures/" + textures[i]["name"] + ".bmp"
-	f = open(name, 'wb')
-	f.write("BM")
-	#f.write("%d" % 0)
-	#f.write("%d" % 0)
-	#f.write("%d" % 1076)
-	f.write(struct.pack('l', 0))
-	f.write(struct.pack('i', 0))
-	f.write(struct.pack('l', 1078))
-	print f.tell()
-
-	f.write(struct.pack('l', 40))
-	f.write(struct.pack('l', textures[i]["width"]))
-	f.write(struct.pack('l', textures[i]["height"]))
-	f.write(struct.pack('b', 1))
-	f.write(struct.pack('b', 0))
-	f.write(struct.pack('b', 8))
-	f.write(struct.pack('b', 0))
-	f.write(struct.pack('l', 0))
-	f.write(struct.pack('l', 0))
-	f.write(struct.pack('l', 3780))
-	f.write(struct.pack('l', 3780))
-	f.write(struct.pack('l', 0))
-	f.write(struct.pack('l', 0))
-	print f.tell()
-
-	pal = open("palette.lmp", 'rb')
-	for t in range(0, 256):
-		#f.write(pal.read(3))
-		r = pal.read(1)
-		g = pal.read(1)
-		b = pal.read(1)
-		f.write(b)
-		f.write(g)
-		f.write(r)
-		f.write('\0')
-	print f.tell()
-
-	pal.close()
-
-	
-
-	f.write(bsp_file.read(textures[i]["width"] * textures[i]["height"]))
-	f.close()
-
-
-
+            failed += 1
+            print "%8.3fs failed %s: %s" % (seconds, ifile, error)
+        sys.stdout.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print "%i maps, %i failed, %.3fs, %.2f maps/s with %i jobs" % (len(maps),
+            failed, elapsed, len(maps) / max(elapsed, 1e-6), jobs)
+    if profile_file is not None:
+        write_profile(reports)
+    return failed
+
+def watch(args, jobs, interval):
+    # polls the maps every interval seconds. A map is looked at once its
+    # size and mtime stayed the same for one poll, so compilers are done
+    # writing it, and rendered when the hash of its geometry lumps differs
+    # from its last render. Pictures newer than their map count as
+    # rendered on start.
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+    else:
+        pool = None
+    seen = {}
+    settled = {}
+    rendered = {}
+    lumps = BSP_File.geometry_lumps
+    if rewrite_dir is not None:
+        lumps = BSP_File.lump_order
+    elif mesh_format is not None:
+        # texture coordinates and normals are exported too
+        lumps += ('planes', 'texinfo', 'miptex')
+    while True:
+        changed = []
+        for ifile in find_maps(args):
+            if split_member(ifile)[0] is not None:
+                # archives are not watched
+                continue
+            try:
+                st = os.stat(ifile)
+            except OSError:
+                continue
+            key = (st.st_size, st.st_mtime)
+            previous = seen.get(ifile)
+            seen[ifile] = key
+            if previous != key or settled.get(ifile) == key:
+                continue
+            first = ifile not in settled
+            settled[ifile] = key
+
+            try:
+                f = BSP_File(ifile, False, True)
+                if f.invalid == True:
+                    continue
+                digest = f.lump_hash(lumps)
+            except Exception, err:
+                # a broken map, wait for the next write
+                print "         broken %s: %s: %s" % (ifile, err.__class__.__name__, err)
+                continue
+            if first:
+                if rewrite_dir is not None:
+                    outputfile = rewrite_name(ifile)
+                elif mesh_format is not None:
+                    outputfile = output_name(ifile, "." + mesh_format)
+                elif pyramid:
+                    outputfile = os.path.join(output_name(ifile, ""), "manifest.json")
+                else:
+                    outputfile = output_name(ifile, ".png")
+                if os.path.isfile(outputfile) and os.stat(outputfile).st_mtime >= st.st_mtime:
+                    rendered[ifile] = digest
+            if rendered.get(ifile) == digest:
+                if not first:
+                    print "         same   %s, geometry unchanged" % ifile
+                continue
+            rendered[ifile] = digest
+            changed.append(ifile)
+
+        if pool is not None:
+            results = pool.imap_unordered(render_job, changed)
+        else:
+            results = itertools.imap(render_job, changed)
+        for ifile, seconds, outputfile, error, report in results:
+            if error is None:
+                print "%8.3fs ok     %s -> %s" % (seconds, ifile, outputfile)
+            else:
+                # try again on its next change
+                rendered.pop(ifile, None)
+                print "%8.3fs failed %s: %s" % (seconds, ifile, error)
+            sys.stdout.flush()
+        time.sleep(interval)
+
+# largest picture the service renders, in pixels
+service_pixels = 4096 * 4096
+
+class Map_Service(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # renders overviews of the maps below root on request, keeps the
+    # parsed maps of the last requests and lets jobs requests render at
+    # once, the others wait
+    daemon_threads = True
+
+    # lumps and derived tables the requests read. The lazy loaders are not
+    # safe to run from several threads at once, these are all loaded
+    # before a map is shared.
+    lumps = ('models', 'faces', 'vertices')
+    tables = ('polygon_offsets', 'polygon_vertices', 'face_mins', 'face_maxs',
+        'bvh_faces', 'bvh_mins', 'bvh_maxs')
+
+    def __init__(self, address, root, jobs, cache_size):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Map_Handler)
+        self.root = os.path.abspath(root)
+        self.maps = LRU_Cache(cache_size)
+        self.lock = threading.Lock()
+        self.workers = threading.BoundedSemaphore(jobs)
+
+    def open(self, name):
+        # a parsed map, parsed again when its file changed
+        pakfile, member = split_member(name)
+        path = os.path.normpath(os.path.join(self.root, pakfile or member))
+        if not path.startswith(os.path.join(self.root, '')):
+            raise IOError("\"%s\" is outside of the served directory" % name)
+        if pakfile is not None:
+            path = "%s:%s" % (path, member)
+        st = os.stat(split_member(path)[0] or path)
+        key = (st.st_size, st.st_mtime)
+        with self.lock:
+            entry = self.maps.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        f = open_map(path, use_mmap, True)
+        if f.invalid == True:
+            raise IOError(f.error)
+        for name in Map_Service.lumps:
+            f.lump_array(name)
+        for name in Map_Service.tables:
+            getattr(f, name)
+        with self.lock:
+            self.maps.put(path, (key, f))
+        return f
+
+class Map_Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # GET /render?map=e1m1.bsp&model=0&scale=1&region=x0,y0,x1,y1 answers
+    # with a png, the region defaults to the extent of the model
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/render":
+            self.send_error(404, "only /render is served")
+            return
+        query = urlparse.parse_qs(url.query)
+        try:
+            name = query['map'][0]
+            model = int(query.get('model', ['0'])[0])
+            scale = float(query.get('scale', ['1'])[0])
+            region = query.get('region', [None])[0]
+            if scale <= 0:
+                raise ValueError("scale has to be positive")
+
+            with self.server.workers:
+                start = time.time()
+                f = self.server.open(name)
+                if model < 0 or model >= f.header['models']['num']:
+                    raise ValueError("no model %i" % model)
+                if region is None:
+                    faces = f.model_faces(model)
+                    if len(faces) == 0:
+                        raise ValueError("model %i has no faces" % model)
+                    mins = f.face_mins[faces, :2].min(axis=0).astype(numpy.float64)
+                    maxs = f.face_maxs[faces, :2].max(axis=0).astype(numpy.float64)
+                else:
+                    region = [float(v) for v in region.split(',')]
+                    if len(region) != 4:
+                        raise ValueError("region is x0,y0,x1,y1")
+                    mins = numpy.array(region[:2])
+                    maxs = numpy.array(region[2:])
+                size = (maxs - mins) * scale
+                if (size < 1).any() or size[0] * size[1] > service_pixels:
+                    raise ValueError("a %ix%i picture is out of range" % tuple(size))
+                pixels = render_region(f, model, mins, maxs, scale)
+            out = StringIO.StringIO()
+            png = PNG_Writer(out, pixels.shape[1], pixels.shape[0])
+            png.write(pixels)
+            png.close()
+        except KeyError, err:
+            self.send_error(400, "missing parameter %s" % err)
+            return
+        except (IOError, OSError, ValueError), err:
+            self.send_error(400, str(err))
+            return
+        except Exception, err:
+            # a broken map
+            self.send_error(500, "%s: %s" % (err.__class__.__name__, err))
+            return
+
+        data = out.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Render-Seconds", "%.4f" % (time.time() - start))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(port, root, jobs, cache_size=32):
+    server = Map_Service(("127.0.0.1", port), root, jobs, cache_size)
+    print "serving maps below %s on http://127.0.0.1:%i/render" % (server.root, port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+def main():
+    global use_mmap, software, tile_size, resolution, cache_dir, pyramid
+    global profile_file, profile, mesh_format, group_textures
+    global rewrite_dir, strip_lumps, compact_maps
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hlmzsj:tp:T:r:c:Zw:S:e:gW:x:k', ['profile='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+
+    jobs = 1
+    textures = False
+    interval = None
+    port = None
+    palettefile = "palette.lmp"
+    for o, a in opts:
+        if o == "-h":
+            usage()
+        elif o == "-l":
+            list_only = 1
+            print "listing files only"
+        elif o == "-m":
+            use_mmap = True
+        elif o == "-z":
+            # maps are always opened lazily now
+            pass
+        elif o == "-s":
+            software = True
+        elif o == "-j":
+            jobs = max(int(a), 1)
+        elif o == "-t":
+            textures = True
+        elif o == "-p":
+            palettefile = a
+        elif o == "-T":
+            tile_size = max(int(a), 1)
+        elif o == "-r":
+            resolution = float(a)
+        elif o == "-c":
+            cache_dir = a
+        elif o == "-Z":
+            pyramid = True
+        elif o == "-w":
+            interval = float(a)
+        elif o == "-S":
+            port = int(a)
+        elif o == "-e":
+            if a.lower() not in ("obj", "glb"):
+                usage()
+            mesh_format = a.lower()
+        elif o == "-g":
+            group_textures = True
+        elif o == "-W":
+            rewrite_dir = a
+        elif o == "-x":
+            strip_lumps = a.split(",")
+            for name in strip_lumps:
+                if name not in BSP_File.lump_order:
+                    print "unknown lump %s" % name
+                    usage()
+        elif o == "-k":
+            compact_maps = True
+        elif o == "--profile":
+            profile_file = a
+        else :
+            print "unknown option %s" % o
+
+    if port is not None:
+        try:
+            serve(port, (args + ["."])[0], jobs)
+        except KeyboardInterrupt:
+            pass
+        return
 
+    if len(args) < 1:
+        usage()
 
-
-#bsp_file.fseek()
-
-bsp_file.close()
+    if interval is not None:
+        try:
+            watch(args, jobs, interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if textures:
+        if export_textures(find_maps(args), palettefile, jobs):
+            sys.exit(1)
+        return
+
+    if len(args) > 1 or jobs > 1 or not os.path.isfile(args[0]) or args[0].lower().endswith(".pak"):
+        maps = find_maps(args)
+        if rewrite_dir is not None:
+            collisions = rewrite_collisions(maps)
+            for first, second, outputfile in collisions:
+                print "%s and %s would both be written to %s" % (first, second, outputfile)
+            if collisions:
+                sys.exit(1)
+        if render_batch(maps, jobs):
+            sys.exit(1)
+        return
+
+    ifile = args[0]
+    if profile_file is not None:
+        profile = Profile(ifile)
+    try:
+        outputfile = render_map(ifile, True)
+    except IOError, err:
+        print err
+        sys.exit()
+
+    print outputfile 
+    if profile is not None:
+        write_profile([profile.finish()])
+
+    print "test"
+
+
+if __name__ == "__main__":
+    main()